@@ -0,0 +1,60 @@
+"""
+Micro-benchmark of listing output formatting and file name sanitization.
+
+    python benchmarks/bench_format.py [-n ITEMS]
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_vkontakte_music'))
+import tools
+
+
+ARTISTS = ['Artist %d' % n for n in range(500)] + ['Исполнитель %d' % n for n in range(500)] + ['AC/DC', 'Who?: "Live"']
+TITLES = ['Track %d' % n for n in range(2000)] + ['Песня <%d>' % n for n in range(2000)]
+
+
+def make_audios(count, seed=0):
+    rnd = random.Random(seed)
+    return [{
+        'id': n,
+        'owner_id': 1,
+        'artist': rnd.choice(ARTISTS),
+        'title': rnd.choice(TITLES),
+        'url': 'https://cs1.vk.me/u1/audios/%x.mp3' % n,
+        'duration': rnd.randint(60, 600),
+    } for n in range(count)]
+
+
+def timed(name, function, count):
+    started = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - started
+    print('{:<28} {:>9.1f} ms {:>12.0f} items/s'.format(name, elapsed * 1000, count / elapsed))
+
+
+def write_all(audios, print_part, output_format):
+    with tools.RecordWriter(tools.AUDIO_CONFIG, print_part, output_format, stream=io.StringIO()) as writer:
+        for audio in audios:
+            writer.write(audio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--items', type=int, default=100000)
+    args = parser.parse_args()
+    audios = make_audios(args.items)
+    timed('filter_text', lambda: [tools.filter_text(a['artist']) for a in audios], args.items)
+    timed('make_full_audio_filename', lambda: [tools.make_full_audio_filename(a, 'music') for a in audios], args.items)
+    timed('format_audio', lambda: [tools.format_audio(a) for a in audios], args.items)
+    for output_format in tools.OUTPUT_FORMATS:
+        timed('write ' + output_format, lambda: write_all(audios, None, output_format), args.items)
+    timed('write text id+name', lambda: write_all(audios, 'id+name', 'text'), args.items)
+
+
+if __name__ == '__main__':
+    main()
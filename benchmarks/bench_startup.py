@@ -0,0 +1,60 @@
+"""
+Startup time of the command line tool.
+
+    python benchmarks/bench_startup.py [-n RUNS]
+
+Runs the tool with arguments that exit right after parsing and reports wall time per invocation,
+plus import time of the modules loaded before any request is made.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_vkontakte_music')
+COMMANDS = [
+    ['--help'],
+    ['music', 'list', '--help'],
+    ['music', 'download', '--help'],
+    ['friend', 'list', 'album', '--help'],
+]
+
+
+def run_times(command, runs):
+    times = list()
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, 'run.py'] + command, cwd=PACKAGE_DIR,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def import_time():
+    """:return float: seconds to import modules needed to parse arguments."""
+    code = 'import time; t = time.perf_counter(); import tools, actions, vkontakte, cache, stats; ' \
+           'print(time.perf_counter() - t)'
+    output = subprocess.run([sys.executable, '-c', code], cwd=PACKAGE_DIR, stdout=subprocess.PIPE, check=True).stdout
+    return float(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    args = parser.parse_args()
+    for command in COMMANDS:
+        times = run_times(command, args.runs)
+        print('{:<36} min={:.1f}ms mean={:.1f}ms'.format(
+            ' '.join(command), min(times) * 1000, sum(times) / len(times) * 1000))
+    print('{:<36} {:.1f}ms'.format('import modules', import_time() * 1000))
+    interpreter = list()
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        interpreter.append(time.perf_counter() - started)
+    print('{:<36} min={:.1f}ms'.format('bare interpreter', min(interpreter) * 1000))
+
+
+if __name__ == '__main__':
+    main()
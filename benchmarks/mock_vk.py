@@ -0,0 +1,298 @@
+"""
+Local stand-in for api.vk.com/method/* and the audio CDN.
+
+    python benchmarks/mock_vk.py --port 8080 --audios 10000 --latency 0.05
+
+Serves paged audio.get, audio.getAlbums, audio.getById, audio.search, friends.get and groups.get,
+execute with API.<method>({...}) calls, and /cdn/<owner_id>_<id>.mp3 files with Range support.
+Latency, per connection bandwidth and error rates are configurable.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+
+EXECUTE_CALL = re.compile(r'API\.([\w.]+)\((\{.*?\})\)')
+OWNER_ID = 1
+MP3_FRAME_HEADER = b'\xff\xfb\x90\x64'
+MP3_FRAME_SIZE = 417
+
+
+class MockConfig(object):
+    def __init__(self, audios=10000, friends=200, groups=100, albums=20, file_size=256 * 1024,
+                 latency=0.0, cdn_latency=0.0, bandwidth=0, error_rate=0.0, cdn_error_rate=0.0, seed=0):
+        """
+        :param float latency: seconds added to every API response.
+        :param int bandwidth: bytes per second per CDN connection, 0 is unlimited.
+        :param float error_rate: share of API requests answered with error 6.
+        :param float cdn_error_rate: share of CDN requests cut in the middle of the body.
+        """
+        self.audios = audios
+        self.friends = friends
+        self.groups = groups
+        self.albums = albums
+        self.file_size = file_size
+        self.latency = latency
+        self.cdn_latency = cdn_latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.cdn_error_rate = cdn_error_rate
+        self.seed = seed
+
+
+class MockLibrary(object):
+    def __init__(self, config, base_url):
+        rnd = random.Random(config.seed)
+        self.audios = [{
+            'id': n,
+            'owner_id': OWNER_ID,
+            'artist': 'Artist %d' % rnd.randint(0, 999),
+            'title': 'Title %d' % n,
+            'duration': rnd.randint(60, 600),
+            'album_id': n % config.albums if config.albums else 0,
+            'url': '{}/cdn/{}_{}.mp3'.format(base_url, OWNER_ID, n),
+        } for n in range(config.audios, 0, -1)]
+        self.audio_by_id = dict(('{}_{}'.format(a['owner_id'], a['id']), a) for a in self.audios)
+        self.albums = [{'id': n, 'owner_id': OWNER_ID, 'title': 'Album %d' % n} for n in range(config.albums)]
+        self.friends = [{'id': 1000 + n, 'first_name': 'Friend', 'last_name': str(n), 'screen_name': 'id%d' % n}
+                        for n in range(config.friends)]
+        self.groups = [{'id': 5000 + n, 'name': 'Group %d' % n, 'screen_name': 'club%d' % n}
+                       for n in range(config.groups)]
+        # MPEG 1 Layer III 128kbps 44.1kHz frames, served over and over to fill file_size
+        self.body = b''.join(MP3_FRAME_HEADER + bytes(rnd.getrandbits(8) for _ in range(MP3_FRAME_SIZE - 4))
+                             for _ in range(max(min(config.file_size, 64 * 1024) // MP3_FRAME_SIZE, 1)))
+
+    def page(self, items, params):
+        offset = int(params.get('offset', 0))
+        count = int(params.get('count', 100))
+        return {'count': len(items), 'items': items[offset:offset + count]}
+
+    def method(self, name, params):
+        if name == 'audio.get':
+            items = self.audios
+            if params.get('album_id'):
+                items = [a for a in items if a['album_id'] == int(params['album_id'])]
+            if params.get('audio_ids'):
+                ids = set(int(i) for i in str(params['audio_ids']).split(','))
+                items = [a for a in items if a['id'] in ids]
+            return self.page(items, params)
+        if name == 'audio.getById':
+            return [self.audio_by_id[key] for key in str(params.get('audios', '')).split(',') if key in self.audio_by_id]
+        if name == 'audio.search':
+            query = str(params.get('q', '')).lower()
+            return self.page([a for a in self.audios if query in a['artist'].lower() or query in a['title'].lower()],
+                             params)
+        if name == 'audio.getAlbums':
+            return self.page(self.albums, params)
+        if name == 'friends.get':
+            return self.page(self.friends, params)
+        if name == 'groups.get':
+            return self.page(self.groups, params)
+        if name == 'users.get':
+            return [{'id': OWNER_ID, 'first_name': 'Mock', 'last_name': 'User'}]
+        raise KeyError(name)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, code, message, params):
+        return {'error': {'error_code': code, 'error_msg': message,
+                          'request_params': [{'key': k, 'value': v} for k, v in params.items()]}}
+
+    def api(self, name, params):
+        server = self.server
+        if server.config.latency:
+            time.sleep(server.config.latency)
+        server.count('api')
+        if server.config.error_rate and server.random() < server.config.error_rate:
+            return self.error(6, 'Too many requests per second', params)
+        if name == 'execute':
+            response, errors = list(), list()
+            for method, call_params in EXECUTE_CALL.findall(params.get('code', '')):
+                try:
+                    response.append(server.library.method(method, json.loads(call_params)))
+                except KeyError:
+                    response.append(False)
+                    errors.append({'method': method, 'error_code': 3, 'error_msg': 'Unknown method passed'})
+            data = {'response': response}
+            if errors:
+                data['execute_errors'] = errors
+            return data
+        try:
+            return {'response': server.library.method(name, params)}
+        except KeyError:
+            return self.error(3, 'Unknown method passed', params)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.startswith('/method/'):
+            self.send_json(self.api(url.path[len('/method/'):], dict(parse_qsl(url.query))))
+        elif url.path.startswith('/cdn/'):
+            self.cdn(url.path[len('/cdn/'):], head=False)
+        else:
+            self.send_error(404)
+
+    def do_HEAD(self):
+        url = urlparse(self.path)
+        if url.path.startswith('/cdn/'):
+            self.cdn(url.path[len('/cdn/'):], head=True)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        params = dict(parse_qsl(self.rfile.read(length).decode()))
+        params.update(parse_qsl(url.query))
+        if url.path.startswith('/method/'):
+            self.send_json(self.api(url.path[len('/method/'):], params))
+        else:
+            self.send_error(404)
+
+    def cdn(self, name, head=False):
+        server = self.server
+        if server.config.cdn_latency:
+            time.sleep(server.config.cdn_latency)
+        key = name.rsplit('.', 1)[0]
+        if key not in server.library.audio_by_id:
+            self.send_error(404)
+            return
+        server.count('cdn')
+        size = server.config.file_size
+        start, end = 0, size - 1
+        status = 200
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            elif match.group(2):
+                start = max(size - int(match.group(2)), 0)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        if head:
+            return
+        cut = None
+        if server.config.cdn_error_rate and server.random() < server.config.cdn_error_rate:
+            cut = start + (end - start + 1) // 2
+        self.send_body(start, end + 1 if cut is None else cut)
+        if cut is not None:
+            self.close_connection = True
+
+    def send_body(self, start, end):
+        body = self.server.library.body
+        bandwidth = self.server.config.bandwidth
+        chunk_size = 64 * 1024 if not bandwidth else max(min(64 * 1024, bandwidth // 20), 1024)
+        started = time.monotonic()
+        sent = 0
+        position = start
+        while position < end:
+            offset = position % len(body)
+            chunk = body[offset:offset + min(chunk_size, end - position)]
+            self.wfile.write(chunk)
+            position += len(chunk)
+            sent += len(chunk)
+            if bandwidth:
+                delay = sent / float(bandwidth) - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        ThreadingHTTPServer.__init__(self, (host, port), MockHandler)
+        self.config = config or MockConfig()
+        self.base_url = 'http://{}:{}'.format(*self.server_address[:2])
+        self.library = MockLibrary(self.config, self.base_url)
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self._random = random.Random(self.config.seed)
+        self.thread = None
+
+    @property
+    def api_url(self):
+        return self.base_url + '/method/'
+
+    def random(self):
+        with self.lock:
+            return self._random.random()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_config_arguments(parser):
+    parser.add_argument('--audios', type=int, default=10000, help='Audios in library.')
+    parser.add_argument('--friends', type=int, default=200)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--file_size', type=int, default=256 * 1024, help='Size of every audio file.')
+    parser.add_argument('--latency', type=float, default=0.0, help='API latency, seconds.')
+    parser.add_argument('--cdn_latency', type=float, default=0.0, help='CDN latency, seconds.')
+    parser.add_argument('--bandwidth', type=int, default=0, help='CDN bytes/sec per connection.')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Share of API requests failing with error 6.')
+    parser.add_argument('--cdn_error_rate', type=float, default=0.0, help='Share of CDN transfers cut short.')
+
+
+def config_from_args(args):
+    return MockConfig(audios=args.audios, friends=args.friends, groups=args.groups, file_size=args.file_size,
+                      latency=args.latency, cdn_latency=args.cdn_latency, bandwidth=args.bandwidth,
+                      error_rate=args.error_rate, cdn_error_rate=args.cdn_error_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8080)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    server = MockServer(config_from_args(args), port=args.port)
+    print('Serving API at', server.api_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
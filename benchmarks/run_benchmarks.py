@@ -0,0 +1,190 @@
+"""
+Offline throughput benchmarks against the local mock API and CDN.
+
+    python benchmarks/run_benchmarks.py [--audios 10000] [--latency 0.02] [--jobs 8] [--json results.json]
+
+Reports items/sec for listing, MB/sec for downloads and p50/p99 latencies of API requests and
+file transfers.
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_vkontakte_music'))
+import actions
+import tools
+import vkontakte
+
+import bench_format
+import mock_vk
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class Latencies(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = list()
+
+    def add(self, value):
+        with self.lock:
+            self.values.append(value)
+
+    def report(self):
+        return {'count': len(self.values),
+                'p50_ms': percentile(self.values, 50) * 1000,
+                'p99_ms': percentile(self.values, 99) * 1000}
+
+
+class TimedClient(vkontakte.VkontakteClient):
+    """Client recording latency of every API request."""
+    def __init__(self, *args, **kwargs):
+        vkontakte.VkontakteClient.__init__(self, *args, **kwargs)
+        self.latencies = Latencies()
+
+    def _send(self, method, params, post=False):
+        started = time.perf_counter()
+        try:
+            return vkontakte.VkontakteClient._send(self, method, params, post)
+        finally:
+            self.latencies.add(time.perf_counter() - started)
+
+
+class TimedMusicDownload(actions.MusicDownload):
+    """Download action recording duration of every file transfer."""
+    def __init__(self):
+        self.latencies = Latencies()
+
+    def download(self, audio, destination=None, progress=None):
+        started = time.perf_counter()
+        actions.MusicDownload.download(self, audio, destination, progress)
+        self.latencies.add(time.perf_counter() - started)
+
+
+def make_client(server, args):
+    client = TimedClient('mock-token', pool_size=max(args.jobs * getattr(args, 'segments', 1), args.prefetch),
+                         rate=args.rate)
+    client.api_url = server.api_url
+    client.backoff_base = 0.01
+    return client
+
+
+def make_action(action_class, client, args):
+    action = action_class.__new__(action_class) if action_class is not TimedMusicDownload else action_class()
+    action.client = client
+    action.prefetch = args.prefetch
+    return action
+
+
+def bench_list_items(server, args):
+    client = make_client(server, args)
+    action = make_action(tools.ActionBase, client, args)
+    started = time.perf_counter()
+    count = sum(1 for _ in action.list_items('audio.get'))
+    elapsed = time.perf_counter() - started
+    return dict({'items': count, 'seconds': elapsed, 'items_per_sec': count / elapsed},
+                api=client.latencies.report())
+
+
+def bench_music_list(server, args):
+    client = make_client(server, args)
+    action = make_action(actions.MusicList, client, args)
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    started = time.perf_counter()
+    try:
+        action.run(output_format='ndjson')
+        count = sys.stdout.getvalue().count('\n')
+    finally:
+        sys.stdout = stdout
+    elapsed = time.perf_counter() - started
+    return dict({'items': count, 'seconds': elapsed, 'items_per_sec': count / elapsed},
+                api=client.latencies.report())
+
+
+def bench_music_download(server, args):
+    client = make_client(server, args)
+    action = make_action(TimedMusicDownload, client, args)
+    destination = tempfile.mkdtemp(prefix='pyvkmusic-bench-')
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    started = time.perf_counter()
+    try:
+        action.run(destination=destination, jobs=args.jobs, limit=args.downloads, skip_error=True,
+                   segments=args.segments)
+    finally:
+        sys.stdout = stdout
+    elapsed = time.perf_counter() - started
+    files = [os.path.join(destination, name) for name in os.listdir(destination) if name.endswith('.mp3')]
+    size = sum(os.path.getsize(name) for name in files)
+    shutil.rmtree(destination)
+    return dict({'files': len(files), 'seconds': elapsed, 'files_per_sec': len(files) / elapsed,
+                 'mb_per_sec': size / elapsed / 1024 / 1024},
+                transfer=action.latencies.report(), api=client.latencies.report())
+
+
+def bench_formatting(server, args):
+    audios = bench_format.make_audios(args.audios)
+    started = time.perf_counter()
+    bench_format.write_all(audios, None, 'text')
+    elapsed = time.perf_counter() - started
+    return {'items': len(audios), 'seconds': elapsed, 'items_per_sec': len(audios) / elapsed}
+
+
+BENCHMARKS = [
+    ('list_items', bench_list_items),
+    ('music_list', bench_music_list),
+    ('music_download', bench_music_download),
+    ('formatting', bench_formatting),
+]
+
+
+def print_result(name, result):
+    line = ['{:<16}'.format(name)]
+    for key in ('items_per_sec', 'files_per_sec', 'mb_per_sec'):
+        if key in result:
+            line.append('{}={:.1f}'.format(key, result[key]))
+    for key in ('api', 'transfer'):
+        if key in result and result[key]['count']:
+            line.append('{0} p50={1[p50_ms]:.1f}ms p99={1[p99_ms]:.1f}ms n={1[count]}'.format(key, result[key]))
+    print('  '.join(line))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    mock_vk.add_config_arguments(parser)
+    parser.add_argument('--jobs', type=int, default=8, help='Parallel downloads.')
+    parser.add_argument('--prefetch', type=int, default=4, help='Concurrent listing requests.')
+    parser.add_argument('--rate', type=float, default=1000, help='Client API requests per second.')
+    parser.add_argument('--downloads', type=int, default=200, help='How many audios to download.')
+    parser.add_argument('--segments', type=int, default=1, help='Connections per large file download.')
+    parser.add_argument('--only', nargs='+', choices=[name for name, _ in BENCHMARKS], help='Run only these.')
+    parser.add_argument('--json', help='Write results to this file.')
+    args = parser.parse_args()
+
+    server = mock_vk.MockServer(mock_vk.config_from_args(args)).start()
+    results = dict()
+    try:
+        for name, benchmark in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            results[name] = benchmark(server, args)
+            print_result(name, results[name])
+    finally:
+        server.stop()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
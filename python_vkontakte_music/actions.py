@@ -1,4 +1,14 @@
+import collections
 import os
+import queue
+import shutil
+import threading
+import time
+import cache
+import index
+import journal
+import manifest
+import postprocess
 import tools
 
 
@@ -10,17 +20,23 @@ class MusicList(Music):
     subaction_required = False
     action_name = 'list'
 
-    def run(self, print_part=None, friend_id=None, group_id=None, *args, **kwargs):
-        self.process_id_argument(kwargs)
+    def run(self, print_part=None, friend_id=None, group_id=None, output_format='text', *args, **kwargs):
+        ids = self.process_id_argument(kwargs)
         if friend_id:
             kwargs['owner_id'] = friend_id
         elif group_id:
             kwargs['owner_id'] = -group_id
-        for audio in self.list_items('audio.get', **kwargs):
-            tools.print_audio(audio, print_part)
+        if ids:
+            audios = self.list_by_ids(ids, kwargs.get('owner_id'), kwargs.get('limit'))
+        else:
+            audios = self.list_library('audio.get', **kwargs)
+        with tools.RecordWriter(tools.AUDIO_CONFIG, print_part, output_format) as writer:
+            for audio in audios:
+                writer.write(audio)
 
     def apply_arguments(self, parser):
         self.add_print_part_argument(parser, 'audio', 'id', 'name', 'url')
+        self.add_format_argument(parser)
         self.add_limit_argument(parser, 'audios', 'show')
         self.add_id_argument(parser, 'audio', 'show')
         parser.add_argument('--album_id', type=int, help='List audios in album.')
@@ -32,33 +48,254 @@ class MusicList(Music):
 class MusicListAlbum(MusicList):
     action_name = 'album'
 
-    def run(self, print_part=None, *args, **kwargs):
-        for album in self.list_items('audio.getAlbums', **kwargs):
-            tools.print_album(album, print_part)
+    def run(self, print_part=None, output_format='text', *args, **kwargs):
+        with tools.RecordWriter(tools.ALBUM_CONFIG, print_part, output_format) as writer:
+            for album in self.list_library('audio.getAlbums', **kwargs):
+                writer.write(album)
 
     def apply_arguments(self, parser):
         self.add_print_part_argument(parser, 'album', 'id', 'title')
+        self.add_format_argument(parser)
         self.add_limit_argument(parser, 'albums', 'show')
 
 
-class MusicDownload(Music):
-    action_name = 'download'
-
-    def run(self, interactive=False, skip_error=False, skip_exists=False, destination=None, *args, **kwargs):
-        self.process_id_argument(kwargs)
-        for audio in self.list_items('audio.get', **kwargs):
-            if skip_exists and os.path.exists(tools.make_full_audio_filename(audio, destination)):
+class DownloadMixin(object):
+    """
+    Downloading shared by download actions: destination indexes, scheduler, journal, worker pool
+    and post-processing stage.
+    """
+    skip_exists = False
+    scheduler = tools.DownloadScheduler()
+    journal = None
+    postprocessor = None
+
+    def setup_downloads(self, skip_exists=False, max_rate=None, per_host=None, order='listing', segments=1):
+        self.skip_exists = skip_exists
+        self.indexes = dict()
+        self.indexes_lock = threading.Lock()
+        self.paths = dict()
+        self.paths_lock = threading.Lock()
+        self.scheduler = tools.DownloadScheduler(max_rate, per_host, order, segments)
+
+    def setup_postprocess(self, tag=False, verify=False, workers=None):
+        """Start post-processing pool if files are to be tagged or verified."""
+        if not (tag or verify):
+            return
+        self.albums = dict()
+        if tag:
+            self.albums = dict((album['id'], album['title']) for album in self.list_items('audio.getAlbums'))
+        self.postprocessor = postprocess.PostProcessor(workers, tag, verify)
+
+    def postprocess_done(self, audio, result, destination=None):
+        """
+        Index post-processed file. Invalid file is renamed back to part, so it is neither taken
+        for a downloaded one nor lost, and is downloaded again.
+        """
+        filename = result['filename']
+        if result['error']:
+            if os.path.exists(filename):
+                os.replace(filename, filename + tools.PART_SUFFIX)
+            if self.journal is not None:
+                self.journal.record(audio, 'failed', error=result['error'])
+            return
+        destination_index = self.get_index(destination)
+        if destination_index is not None:
+            destination_index.add(audio, filename)
+        if self.journal is not None:
+            self.journal.record(audio, 'done', size=os.path.getsize(filename), checksum=result['checksum'])
+
+    def finish_postprocess(self):
+        if self.postprocessor is not None:
+            self.postprocessor.close()
+            self.postprocessor.summary()
+
+    def get_index(self, destination):
+        """:return index.DestinationIndex: index of destination, if skip_exists is set."""
+        if not self.skip_exists:
+            return None
+        with self.indexes_lock:
+            if destination not in self.indexes:
+                self.indexes[destination] = index.DestinationIndex(destination)
+            return self.indexes[destination]
+
+    def save_indexes(self):
+        for destination_index in getattr(self, 'indexes', dict()).values():
+            destination_index.save()
+
+    def lock_path(self, filename):
+        """
+        Wait until no other download writes to filename. Audios with the same artist and title
+        are saved to the same file, so they are downloaded one after another.
+        """
+        with self.paths_lock:
+            lock, users = self.paths.get(filename, (None, 0))
+            lock = lock or threading.Lock()
+            self.paths[filename] = (lock, users + 1)
+        lock.acquire()
+
+    def unlock_path(self, filename):
+        with self.paths_lock:
+            lock, users = self.paths.pop(filename)
+            if users > 1:
+                self.paths[filename] = (lock, users - 1)
+        lock.release()
+
+    def download(self, audio, destination=None, progress=None):
+        filename = tools.make_full_audio_filename(audio, destination)
+        self.lock_path(filename)
+        unlock = True
+        try:
+            destination_index = self.get_index(destination)
+            if destination_index is not None and destination_index.find(audio, filename):
+                return  # audio of the same name was downloaded while this one waited
+            if self.journal is not None:
+                self.journal.record(audio, 'started')
+            try:
+                self.scheduler.download(audio, destination, progress, self.client.session)
+            except Exception as e:
+                if self.journal is not None:
+                    self.journal.record(audio, 'failed', error=str(e) or e.__class__.__name__)
+                raise
+            if self.postprocessor is not None:
+                def done(audio, result):
+                    try:
+                        self.postprocess_done(audio, result, destination)
+                    finally:
+                        self.unlock_path(filename)
+
+                # Index and journal are updated and file is unlocked when post-processing is done
+                self.postprocessor.submit(audio, filename, self.albums.get(audio.get('album_id')), done)
+                unlock = False
+                return
+            if self.journal is not None:
+                self.journal.record(audio, 'done', size=os.path.getsize(filename),
+                                    checksum=tools.file_checksum(filename))
+            if destination_index is not None:
+                destination_index.add(audio, filename)
+        finally:
+            if unlock:
+                self.unlock_path(filename)
+
+    def iter_downloads(self, audios, interactive=False, destination=None):
+        for audio in audios:
+            destination_index = self.get_index(destination)
+            if destination_index and destination_index.find(audio, tools.make_full_audio_filename(audio, destination)):
                 continue
             if interactive and not tools.ask('Download '+ tools.format_audio(audio, print_part='name')):
                 continue
+            if self.journal is not None:
+                self.journal.record(audio, 'queued', filename=tools.make_full_audio_filename(audio, destination))
+            yield audio
+
+    def get_owners(self, owner_ids=None, all_friends=False, all_groups=False):
+        """:return list: (owner_id, folder) pairs."""
+        owners = [(owner, str(owner) if owner else 'own') for owner in owner_ids or list()]
+        if all_friends:
+            for friend in self.list_items('friends.get', fields='screen_name'):
+                owners.append((friend['id'], tools.filter_text(
+                    '{} {} {}'.format(friend['id'], friend['first_name'], friend['last_name']))))
+        if all_groups:
+            for group in self.list_items('groups.get', extended=1):
+                owners.append((-group['id'], tools.filter_text('{} {}'.format(-group['id'], group['name']))))
+        return owners
+
+    def download_parallel(self, tasks, jobs, skip_error=False, on_done=None):
+        """
+        Download audios on a bounded pool of jobs threads with one aggregated progress line.
+
+        :param tasks: iterable of (audio, destination) pairs.
+        :param on_done: function called with audio, destination and error (None on success).
+        """
+        progress = tools.DownloadProgress()
+        failed = threading.Event()
+
+        def download(audio, destination):
+            key = index.audio_key(audio)
             try:
-                tools.download_audio(audio, destination)
+                self.download(audio, destination, progress)
             except Exception as e:
-                if skip_error:
-                    print('While: {} Error: {}'.format(tools.format_audio(audio, 'id+name'), e))
-                    continue
-                else:
+                progress.finish(key, e, tools.make_full_audio_filename(audio, destination))
+                if on_done:
+                    on_done(audio, destination, e)
+                if not skip_error:
+                    failed.set()
                     raise
+            else:
+                progress.finish(key)
+                if on_done:
+                    on_done(audio, destination, None)
+
+        futures = list()
+        with tools.BoundedExecutor(jobs) as executor:
+            for audio, destination in tasks:
+                if failed.is_set():
+                    break
+                futures.append(executor.submit(download, audio, destination))
+                futures = [future for future in futures if not future.done() or future.exception()]
+        progress.summary()
+        print('Connections: {opened} opened, {reused} reused.'.format(**self.client.connection_stats()))
+        for future in futures:
+            if future.exception():
+                raise future.exception()
+
+
+class MusicDownload(DownloadMixin, Music):
+    action_name = 'download'
+
+    def run(self, interactive=False, skip_error=False, skip_exists=False, destination=None, jobs=1,
+            max_rate=None, per_host=None, order='listing', manifest_file=None, shard=None, segments=1,
+            use_journal=False, resume=False, tag=False, verify=False, post_workers=None, *args, **kwargs):
+        ids = self.process_id_argument(kwargs)
+        self.setup_downloads(skip_exists, max_rate, per_host, order, segments)
+        self.setup_postprocess(tag, verify, post_workers)
+        journal_file = os.path.join(destination or '.', journal.JOURNAL_FILENAME)
+        state = journal.replay(journal_file) if resume else None
+        if use_journal or resume:
+            self.journal = journal.DownloadJournal(journal_file)
+            if state is not None:
+                self.journal.compact(state)
+        if state is not None and state.listed:
+            unfinished = state.unfinished()
+            print('Resuming {} unfinished audios.'.format(len(unfinished)))
+            audios = self.scheduler.order(self.list_by_ids(unfinished))
+        elif manifest_file:
+            audios = manifest.read_manifest(manifest_file)
+            if shard:
+                audios = manifest.select_shard(audios, *shard)
+            audios = self.scheduler.order([entry for entry in audios if not entry.get('exists')])
+        elif ids:
+            audios = self.scheduler.order(self.list_by_ids(ids, limit=kwargs.get('limit')))
+        else:
+            audios = self.scheduler.order(self.list_items('audio.get', **kwargs))
+        if state is not None and not state.listed:
+            # Journal of a run that died while listing, list again skipping what is done
+            done = state.done()
+            audios = (audio for audio in audios if index.audio_key(audio) not in done)
+        audios = self.iter_downloads(audios, interactive, destination)
+        if self.journal is not None:
+            audios = self.journal_listing(audios)
+        try:
+            if jobs > 1:
+                return self.download_parallel(((audio, destination) for audio in audios), jobs, skip_error)
+            for audio in audios:
+                try:
+                    self.download(audio, destination)
+                except Exception as e:
+                    if skip_error:
+                        print('While: {} Error: {}'.format(tools.format_audio(audio, 'id+name'), e))
+                        continue
+                    else:
+                        raise
+        finally:
+            self.finish_postprocess()
+            self.save_indexes()
+            if self.journal is not None:
+                self.journal.close()
+
+    def journal_listing(self, audios):
+        for audio in audios:
+            yield audio
+        self.journal.listed()
 
     def apply_arguments(self, parser):
         self.add_limit_argument(parser, 'audios', 'download')
@@ -68,22 +305,320 @@ class MusicDownload(Music):
         parser.add_argument('--skip_error', action='store_true', help='Continue download if an error occurred.')
         parser.add_argument('--skip_exists', action='store_true', help='Do not download existing audios.')
         parser.add_argument('--destination', type=tools.directory_type, help='Directory where to store downloads.')
+        parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel downloads. Default is 1.')
+        parser.add_argument('--max_rate', type=tools.size_type, help='Total download speed limit, bytes/sec (e.g. 512K, 2M).')
+        parser.add_argument('--per_host', type=int, help='Maximum parallel downloads from one host.')
+        parser.add_argument('--order', choices=tools.DOWNLOAD_ORDERS, default='listing',
+                            help='Download order: API listing, smallest first or by album. Default is listing.')
+        parser.add_argument('--segments', type=int, default=1,
+                            help='Download files larger than %dMB over this many connections. Default is 1.'
+                                 % (2 * tools.SEGMENT_MIN_SIZE // 1024 // 1024))
+        parser.add_argument('--journal', dest='use_journal', action='store_true',
+                            help='Record state of every download in %s in destination.' % journal.JOURNAL_FILENAME)
+        parser.add_argument('--resume', action='store_true',
+                            help='Download only audios the journal of an interrupted run has not finished.')
+        parser.add_argument('--tag', action='store_true', help='Write artist, title and album ID3 tags to downloaded files.')
+        parser.add_argument('--verify', action='store_true',
+                            help='Check that downloaded files are complete MP3s and compute their checksums.')
+        parser.add_argument('--post_workers', type=int,
+                            help='Processes tagging and verifying files while downloads go on. Default is number of CPUs.')
+        parser.add_argument('--manifest', dest='manifest_file',
+                            help='Download audios not existing at planning time from manifest made by music plan, '
+                                 'instead of listing them.')
+        parser.add_argument('--shard', type=manifest.shard_type,
+                            help='With --manifest, download only this part of it, like 2/4. '
+                                 'Parts are balanced by size.')
+
+
+class MusicPlan(DownloadMixin, Music):
+    action_name = 'plan'
+
+    def run(self, manifest_file, destination=None, jobs=8, max_rate=None, *args, **kwargs):
+        ids = self.process_id_argument(kwargs)
+        self.setup_downloads(skip_exists=True)
+        destination_index = self.get_index(destination)
+
+        def entries():
+            if ids:
+                audios = self.list_by_ids(ids, limit=kwargs.get('limit'))
+            else:
+                audios = self.list_items('audio.get', **kwargs)
+            for audio, size, error in tools.probe_sizes(audios, jobs, self.client.session):
+                entry = manifest.make_entry(audio, tools.make_full_audio_filename(audio, destination), size,
+                                            error=error)
+                # Entry has probed size, files whose names lost characters are matched by it
+                entry.exists = destination_index.find(entry, entry.filename) is not None
+                yield entry
+
+        try:
+            summary = manifest.summarize(manifest.write_manifest(manifest_file, entries()))
+        finally:
+            self.save_indexes()
+        print('Planned {} audios, {}.'.format(summary['audios'], tools.format_size(summary['bytes'])))
+        print('Already exist: {} audios, {}.'.format(summary['existing'], tools.format_size(summary['existing_bytes'])))
+        print('To download: {} audios, {}, size of {} unknown.'.format(
+            summary['pending'], tools.format_size(summary['pending_bytes']), summary['unknown_size']))
+        free = shutil.disk_usage(destination or '.').free
+        if free < summary['pending_bytes']:
+            print('Not enough disk space: {} free.'.format(tools.format_size(free)))
+        if max_rate:
+            print('Estimated time at {}/s: {:.0f}s.'.format(tools.format_size(max_rate), summary['pending_bytes'] / max_rate))
+
+    def apply_arguments(self, parser):
+        self.add_limit_argument(parser, 'audios', 'plan')
+        self.add_id_argument(parser, 'audio', 'plan')
+        parser.add_argument('--album_id', type=int, help='Plan audios from album.')
+        parser.add_argument('--destination', type=tools.directory_type, help='Directory where downloads are to be stored.')
+        parser.add_argument('-j', '--jobs', type=int, default=8, help='Number of parallel size probes. Default is 8.')
+        parser.add_argument('--max_rate', type=tools.size_type, help='Download speed to estimate time with, bytes/sec (e.g. 2M).')
+        parser.add_argument('manifest_file', metavar='manifest', help='File to write manifest to.')
+
+
+class MusicSync(DownloadMixin, Music):
+    action_name = 'sync'
+
+    def run(self, owner_id=None, all_friends=False, all_groups=False, destination=None, jobs=4, limit=None,
+            skip_error=False, skip_exists=False, max_rate=None, per_host=None, *args, **kwargs):
+        self.setup_downloads(skip_exists, max_rate, per_host)
+        owners = [(owner, os.path.join(destination or '.', folder))
+                  for owner, folder in self.get_owners(owner_id, all_friends, all_groups)]
+        if not owners:
+            print('Nothing to sync: specify --owner_id, --all_friends or --all_groups.')
+            return
+        reports = collections.OrderedDict((folder, {'listed': 0, 'downloaded': 0, 'failed': 0, 'error': None})
+                                          for owner, folder in owners)
+        reports_lock = threading.Lock()
+        work = queue.Queue(maxsize=jobs * 4)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    work.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+
+        def list_owner(owner, folder):
+            try:
+                for audio in self.list_items('audio.get', owner_id=owner, limit=limit):
+                    put((owner, folder, audio))
+                    if stop.is_set():
+                        return
+            except Exception as e:
+                reports[folder]['error'] = e
+            finally:
+                put((owner, folder, None))
+
+        def tasks():
+            remaining = len(owners)
+            while remaining:
+                owner, folder, audio = work.get()
+                if audio is None:
+                    remaining -= 1
+                    continue
+                reports[folder]['listed'] += 1
+                for audio in self.iter_downloads([audio], destination=folder):
+                    yield audio, folder
+
+        def on_done(audio, folder, error):
+            with reports_lock:
+                reports[folder]['failed' if error else 'downloaded'] += 1
+
+        for owner, folder in owners:
+            os.makedirs(folder, exist_ok=True)
+        listing = tools.BoundedExecutor(max(min(self.prefetch, len(owners)), 1), len(owners))
+        for owner, folder in owners:
+            listing.submit(list_owner, owner, folder)
+        try:
+            self.download_parallel(tasks(), jobs, skip_error, on_done)
+        finally:
+            stop.set()
+            listing.shutdown()
+            self.save_indexes()
+            self.print_reports(reports)
+
+    def print_reports(self, reports):
+        for folder, report in reports.items():
+            line = '{}: listed {}, downloaded {}, failed {}'.format(
+                folder, report['listed'], report['downloaded'], report['failed'])
+            if report['error'] is not None:
+                line += ', listing error: {}'.format(report['error'])
+            print(line)
+
+    def apply_arguments(self, parser):
+        parser.add_argument('--owner_id', type=int, nargs='+', help='Owner ids to sync, negative for groups.')
+        parser.add_argument('--all_friends', action='store_true', help='Sync audios of all friends.')
+        parser.add_argument('--all_groups', action='store_true', help='Sync audios of all groups.')
+        self.add_limit_argument(parser, 'audios of every owner', 'download')
+        parser.add_argument('--destination', type=tools.directory_type,
+                            help='Directory where to store downloads, every owner gets own folder in it.')
+        parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of parallel downloads. Default is 4.')
+        parser.add_argument('--skip_error', action='store_true', help='Continue download if an error occurred.')
+        parser.add_argument('--skip_exists', action='store_true', help='Do not download existing audios.')
+        parser.add_argument('--max_rate', type=tools.size_type, help='Total download speed limit, bytes/sec (e.g. 512K, 2M).')
+        parser.add_argument('--per_host', type=int, help='Maximum parallel downloads from one host.')
+
+
+class MusicWatch(DownloadMixin, Music):
+    action_name = 'watch'
+
+    def log(self, message):
+        print('[{}] {}'.format(time.strftime('%Y-%m-%d %H:%M:%S'), message))
+
+    def run(self, owner_id=None, all_friends=False, all_groups=False, destination=None, interval=600,
+            max_backoff=3600, iterations=None, jobs=4, max_rate=None, per_host=None, max_retries=5, *args, **kwargs):
+        """
+        Poll owners every interval seconds and download audios added since the last poll.
+        Owners failing to sync are polled again after exponentially growing delay, up to max_backoff.
+        Failed audios are retried the same way with fresh urls, up to max_retries times.
+        """
+        if self.cache is None:
+            self.cache = cache.LibraryCache(self.cache_file or cache.CACHE_FILENAME)
+        self.setup_downloads(True, max_rate, per_host)
+        if not (owner_id or all_friends or all_groups):
+            owner_id = [self.client.user_id]
+        owners = [(owner, os.path.join(destination or '.', folder))
+                  for owner, folder in self.get_owners(owner_id, all_friends, all_groups)]
+        if not owners:
+            self.log('Nothing to watch: no friends or groups found.')
+            return
+        for owner, folder in owners:
+            os.makedirs(folder, exist_ok=True)
+        next_poll = dict((folder, 0.0) for owner, folder in owners)
+        failures = dict((folder, 0) for owner, folder in owners)
+        caught_up = set()
+        # Audio key to folder, failed attempts and time to try again
+        failed = dict()
+        failed_lock = threading.Lock()
+
+        def on_done(audio, folder, error):
+            key = index.audio_key(audio)
+            with failed_lock:
+                if error is None:
+                    failed.pop(key, None)
+                    return
+                attempts = failed[key][1] + 1 if key in failed else 1
+                if attempts > max_retries:
+                    failed.pop(key, None)
+                    self.log('{}: giving up {} after {} attempts.'.format(
+                        folder, tools.format_audio(audio, 'name'), attempts))
+                    return
+                failed[key] = (folder, attempts, time.time() + min(interval * 2 ** (attempts - 1), max_backoff))
+
+        n = 0
+        try:
+            while True:
+                tasks = self.retry_tasks(failed)
+                for owner, folder in owners:
+                    if next_poll[folder] > time.time():
+                        continue
+                    try:
+                        items, new = self.sync_library('audio.get', owner_id=owner)
+                        missing = list()
+                        if folder not in caught_up:
+                            missing = self.catch_up(items, new, folder)
+                            caught_up.add(folder)
+                    except Exception as e:
+                        failures[folder] += 1
+                        delay = min(interval * 2 ** failures[folder], max_backoff)
+                        next_poll[folder] = time.time() + delay
+                        self.log('{}: sync failed: {}. Next try in {:.0f}s.'.format(folder, e, delay))
+                        continue
+                    failures[folder] = 0
+                    next_poll[folder] = time.time() + interval
+                    if new:
+                        self.log('{}: {} new audios.'.format(folder, len(new)))
+                    if missing:
+                        self.log('{}: {} audios left by previous runs.'.format(folder, len(missing)))
+                    tasks.extend((audio, folder) for audio in self.iter_downloads(new, destination=folder))
+                    tasks.extend((audio, folder) for audio in missing)
+                if tasks:
+                    self.download_parallel(tasks, jobs, skip_error=True, on_done=on_done)
+                    self.save_indexes()
+                n += 1
+                if iterations and n >= iterations:
+                    break
+                wake = min(list(next_poll.values()) + [next_try for folder, attempts, next_try in failed.values()])
+                time.sleep(max(wake - time.time(), 1))
+        except KeyboardInterrupt:
+            self.log('Stopped.')
+        finally:
+            self.save_indexes()
+
+    def retry_tasks(self, failed):
+        """
+        Get failed audios due to be tried again. Urls of failed audios may have expired,
+        so audios are got again with fresh ones. Audios that are gone are forgotten.
+
+        :param dict failed: audio key to folder, failed attempts and time to try again.
+        :return list: (audio, folder) pairs.
+        """
+        now = time.time()
+        due = [key for key, (folder, attempts, next_try) in list(failed.items()) if next_try <= now]
+        if not due:
+            return list()
+        try:
+            audios = list(self.list_by_ids(due))
+        except Exception as e:
+            self.log('Getting {} failed audios failed: {}. Will try again.'.format(len(due), e))
+            return list()
+        found = set(index.audio_key(audio) for audio in audios)
+        for key in due:
+            if key not in found:
+                del failed[key]
+        return [(audio, failed[index.audio_key(audio)][0]) for audio in audios]
+
+    def catch_up(self, items, new, folder):
+        """
+        Cache is updated before audios are downloaded, so audios a previous run listed but did not download
+        are not new any more. Find cached audios missing from folder and get them again with fresh urls.
+
+        :return list: missing audios.
+        """
+        fresh = set(index.audio_key(audio) for audio in new)
+        missing = [index.audio_key(audio) for audio in self.iter_downloads(items, destination=folder)
+                   if index.audio_key(audio) not in fresh]
+        return list(self.list_by_ids(missing)) if missing else list()
+
+    def apply_arguments(self, parser):
+        parser.add_argument('--owner_id', type=int, nargs='+', help='Owner ids to watch, negative for groups. '
+                                                                    'Default is own audios.')
+        parser.add_argument('--all_friends', action='store_true', help='Watch audios of all friends.')
+        parser.add_argument('--all_groups', action='store_true', help='Watch audios of all groups.')
+        parser.add_argument('--destination', type=tools.directory_type,
+                            help='Directory where to store downloads, every owner gets own folder in it.')
+        parser.add_argument('--interval', type=float, default=600, help='Seconds between polls. Default is 600.')
+        parser.add_argument('--max_backoff', type=float, default=3600,
+                            help='Longest delay between polls of a failing owner, seconds. Default is 3600.')
+        parser.add_argument('--iterations', type=int, help='Stop after N polls. Default is to run forever.')
+        parser.add_argument('--max_retries', type=int, default=5,
+                            help='How many times to retry a failed audio, with growing delay. Default is 5.')
+        parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of parallel downloads. Default is 4.')
+        parser.add_argument('--max_rate', type=tools.size_type, help='Total download speed limit, bytes/sec (e.g. 512K, 2M).')
+        parser.add_argument('--per_host', type=int, help='Maximum parallel downloads from one host.')
 
 
 class MusicSearch(Music):
     action_name = 'search'
+    # audio.search returns only first 1000 results
+    max_results = 1000
 
-    def run(self, print_part=None, *args, **kwargs):
+    def run(self, print_part=None, output_format='text', limit=None, ttl=cache.SEARCH_TTL, *args, **kwargs):
         kwargs['search_own'] = int(kwargs.get('search_own', False))
-        kwargs['count'] = kwargs.pop('limit', 100)
         kwargs['q'] = kwargs.pop('query')
-        for audio in self.client.call('audio.search', **kwargs)['items']:
-            tools.print_audio(audio, print_part)
+        limit = min(limit or self.max_results, self.max_results)
+        with tools.RecordWriter(tools.AUDIO_CONFIG, print_part, output_format) as writer:
+            for audio in self.search_items('audio.search', limit=limit, ttl=ttl, **kwargs):
+                writer.write(audio)
 
     def apply_arguments(self, parser):
         self.add_print_part_argument(parser, 'audio', 'id', 'name', 'url')
+        self.add_format_argument(parser)
         self.add_limit_argument(parser, 'audios', 'show')
         parser.add_argument('--search_own', action='store_true', help='Search in own audios.')
+        parser.add_argument('--ttl', type=float, default=cache.SEARCH_TTL,
+                            help='Seconds to reuse cached results of the same search. Default is %d.' % cache.SEARCH_TTL)
         parser.add_argument('query', type=str, help='Search query.')
 
 
@@ -95,25 +630,29 @@ class GroupList(Group):
     subaction_required = False
     action_name = 'list'
 
-    def run(self, print_part=None, *args, **kwargs):
-        for group in self.list_items('groups.get', extended=1, **kwargs):
-            tools.print_group(group, print_part)
+    def run(self, print_part=None, output_format='text', *args, **kwargs):
+        with tools.RecordWriter(tools.GROUP_CONFIG, print_part, output_format) as writer:
+            for group in self.list_library('groups.get', extended=1, **kwargs):
+                writer.write(group)
 
     def apply_arguments(self, parser):
         self.add_limit_argument(parser, 'groups', 'show')
         self.add_print_part_argument(parser, 'group', 'id', 'name')
+        self.add_format_argument(parser)
 
 
 class GroupListAlbum(GroupList):
     action_name = 'album'
 
-    def run(self, group_id, print_part=None,  *args, **kwargs):
-        for album in self.list_items('audio.getAlbums', owner_id=-group_id, **kwargs):
-            tools.print_album(album, print_part)
+    def run(self, group_id, print_part=None, output_format='text', *args, **kwargs):
+        with tools.RecordWriter(tools.ALBUM_CONFIG, print_part, output_format) as writer:
+            for album in self.list_library('audio.getAlbums', owner_id=-group_id, **kwargs):
+                writer.write(album)
 
     def apply_arguments(self, parser):
         parser.add_argument('group_id', type=int, help='Group id.')
         self.add_print_part_argument(parser, 'album', 'id', 'title')
+        self.add_format_argument(parser)
         self.add_limit_argument(parser, 'albums', 'show')
 
 
@@ -125,23 +664,27 @@ class FriendList(Friend):
     subaction_required = False
     action_name = 'list'
 
-    def run(self, print_part=None, *args, **kwargs):
-        for friend in self.list_items('friends.get', fields='screen_name', **kwargs):
-            tools.print_friend(friend, print_part)
+    def run(self, print_part=None, output_format='text', *args, **kwargs):
+        with tools.RecordWriter(tools.FRIEND_CONFIG, print_part, output_format) as writer:
+            for friend in self.list_library('friends.get', fields='screen_name', **kwargs):
+                writer.write(friend)
 
     def apply_arguments(self, parser):
         self.add_limit_argument(parser, 'friends', 'show')
         self.add_print_part_argument(parser, 'friend', 'id', 'name')
+        self.add_format_argument(parser)
 
 
 class FriendListAlbum(FriendList):
     action_name = 'album'
 
-    def run(self, friend_id, print_part=None,  *args, **kwargs):
-        for album in self.list_items('audio.getAlbums', owner_id=friend_id, **kwargs):
-            tools.print_album(album, print_part)
+    def run(self, friend_id, print_part=None, output_format='text', *args, **kwargs):
+        with tools.RecordWriter(tools.ALBUM_CONFIG, print_part, output_format) as writer:
+            for album in self.list_library('audio.getAlbums', owner_id=friend_id, **kwargs):
+                writer.write(album)
 
     def apply_arguments(self, parser):
         parser.add_argument('friend_id', type=int, help='Friend id.')
         self.add_print_part_argument(parser, 'album', 'id', 'title')
+        self.add_format_argument(parser)
         self.add_limit_argument(parser, 'albums', 'show')
\ No newline at end of file
@@ -0,0 +1,149 @@
+import collections
+import json
+import threading
+import time
+import records
+
+
+CACHE_FILENAME = '.library_cache.sqlite'
+# Parameters that select a page, not a listing
+PAGE_PARAMS = ('count', 'offset')
+# Seconds search results stay valid
+SEARCH_TTL = 3600
+SEARCH_MAX_ENTRIES = 1000
+
+
+def make_scope(method, params):
+    """
+    Make cache key of a listing.
+
+    :param str method: API method.
+    :param dict params: listing parameters. Empty and page parameters are ignored.
+    :return str: scope key.
+    """
+    params = dict((key, str(value)) for key, value in params.items() if value and key not in PAGE_PARAMS)
+    return json.dumps([method, params], sort_keys=True)
+
+
+class LibraryCache(object):
+    """
+    SQLite copy of listed audios, albums, friends and groups.
+
+    Items of one listing are stored under its scope key with position, so they are returned
+    in API order, newest first.
+    """
+    def __init__(self, filename=CACHE_FILENAME):
+        import sqlite3
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS scopes '
+                                    '(scope TEXT PRIMARY KEY, owner_id INTEGER, total INTEGER, synced REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS items '
+                                    '(scope TEXT, owner_id INTEGER, item_id INTEGER, position INTEGER, data TEXT, '
+                                    'PRIMARY KEY (scope, item_id))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS searches '
+                                    '(key TEXT PRIMARY KEY, created REAL, used REAL, data TEXT)')
+
+    def get(self, scope):
+        """
+        :return list: cached items, or None if scope was never synced.
+        """
+        with self.lock:
+            if not self.connection.execute('SELECT 1 FROM scopes WHERE scope = ?', (scope,)).fetchone():
+                return None
+            rows = self.connection.execute('SELECT data FROM items WHERE scope = ? ORDER BY position DESC', (scope,))
+            return [json.loads(row[0]) for row in rows]
+
+    def _set_scope(self, scope, owner_id):
+        total = self.connection.execute('SELECT COUNT(*) FROM items WHERE scope = ?', (scope,)).fetchone()[0]
+        self.connection.execute('INSERT OR REPLACE INTO scopes VALUES (?, ?, ?, ?)', (scope, owner_id, total, time.time()))
+
+    def replace(self, scope, owner_id, items):
+        """Store full listing, items are newest first."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM items WHERE scope = ?', (scope,))
+            self._insert(scope, owner_id, items, 0)
+            self._set_scope(scope, owner_id)
+
+    def prepend(self, scope, owner_id, items):
+        """Store items that are newer than every cached one, items are newest first."""
+        with self.lock, self.connection:
+            start = self.connection.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM items WHERE scope = ?',
+                                            (scope,)).fetchone()[0]
+            self._insert(scope, owner_id, items, start)
+            self._set_scope(scope, owner_id)
+
+    def _insert(self, scope, owner_id, items, start):
+        count = len(items)
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)',
+            ((scope, owner_id, item['id'], start + count - n - 1,
+              json.dumps(item, ensure_ascii=False, default=records.to_json))
+             for n, item in enumerate(items))
+        )
+
+    def get_search(self, key, ttl):
+        """
+        :return tuple: time search results were stored and the results, or None if they are older than ttl seconds.
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT created, data FROM searches WHERE key = ? AND created > ?',
+                                          (key, now - ttl)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE searches SET used = ? WHERE key = ?', (now, key))
+        return row[0], json.loads(row[1])
+
+    def put_search(self, key, items, max_entries=SEARCH_MAX_ENTRIES):
+        """Store search results, evicting least recently used ones above max_entries."""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)',
+                                    (key, now, now, json.dumps(items, ensure_ascii=False, default=records.to_json)))
+            self.connection.execute('DELETE FROM searches WHERE key NOT IN '
+                                    '(SELECT key FROM searches ORDER BY used DESC LIMIT ?)', (max_entries,))
+
+
+class SearchCache(object):
+    """
+    Search results kept in memory and, if library cache is given, on disk too.
+
+    Entries older than ttl seconds are not used. Above max_entries, least recently used entries are evicted.
+    """
+    def __init__(self, library_cache=None, ttl=SEARCH_TTL, max_entries=SEARCH_MAX_ENTRIES):
+        self.library_cache = library_cache
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        """:return list: cached results, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time() - self.ttl:
+                    self.entries.move_to_end(key)
+                    return entry[1]
+                del self.entries[key]
+        if self.library_cache is None:
+            return None
+        found = self.library_cache.get_search(key, self.ttl)
+        if found is None:
+            return None
+        self._remember(key, found[1], found[0])
+        return found[1]
+
+    def put(self, key, items):
+        self._remember(key, items, time.time())
+        if self.library_cache is not None:
+            self.library_cache.put_search(key, items, self.max_entries)
+
+    def _remember(self, key, items, created):
+        with self.lock:
+            self.entries[key] = (created, items)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
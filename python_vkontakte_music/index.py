@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+import tools
+
+
+INDEX_FILENAME = '.pyvkmusic_index.json'
+# Directory modification time the index is valid for, kept next to it
+MTIME_SUFFIX = '.mtime'
+AUDIO_EXTENSION = '.mp3'
+
+
+def normalize_name(filename):
+    """
+    Make a key that matches audio file names differing only in sanitization, case or spacing.
+
+    :param str filename: audio file name.
+    :return str: normalized name.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0].casefold()
+    return ''.join(c for c in name if c.isalnum())
+
+
+def audio_key(audio):
+    return '{}_{}'.format(audio['owner_id'], audio['id'])
+
+
+class DestinationIndex(object):
+    """
+    Index of audio files in download destination.
+
+    The directory is listed once and the index is saved into it. While directory modification time
+    matches the one saved after the index, the saved index is trusted as is. Otherwise only new names
+    are stat'ed.
+    """
+    def __init__(self, destination=None, save_every=100):
+        self.directory = destination or '.'
+        self.filename = os.path.join(self.directory, INDEX_FILENAME)
+        self.mtime_filename = self.filename + MTIME_SUFFIX
+        self.save_every = save_every
+        self.lock = threading.Lock()
+        self.files = dict()
+        self.audios = dict()
+        self.names = dict()
+        self.unsaved = 0
+        mtime = self.load()
+        if mtime != os.stat(self.directory).st_mtime_ns:
+            self.scan()
+        for filename in self.files:
+            self.names[normalize_name(filename)] = filename
+
+    def load(self):
+        """:return int: directory modification time saved with index."""
+        if not os.path.exists(self.filename):
+            return None
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            return None
+        self.files = data.get('files', dict())
+        self.audios = data.get('audios', dict())
+        try:
+            with open(self.mtime_filename, 'rb') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def scan(self):
+        files = dict()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(AUDIO_EXTENSION) or not entry.is_file():
+                    continue
+                if entry.name in self.files:
+                    files[entry.name] = self.files[entry.name]
+                else:
+                    files[entry.name] = entry.stat().st_size
+        self.files = files
+        self.audios = dict((key, filename) for key, filename in self.audios.items() if filename in files)
+        self.unsaved += 1
+
+    def find(self, audio, filename):
+        """
+        Audio is found by its key among downloaded audios, or by exact file name. A file whose name differs
+        only in sanitization, case or spacing is taken for the audio only if the normalized name is not
+        empty, and its size agrees with audio size, if that is known. If the name lost characters to
+        sanitization, size must be known and agree, as different names are sanitized into the same one.
+
+        :param dict audio: audio to look for.
+        :param str filename: file name audio would be saved with.
+        :return str: file name of the audio already in destination, or None.
+        """
+        filename = os.path.basename(filename)
+        key = normalize_name(filename)
+        size = audio.get('size')
+        with self.lock:
+            if self.files.get(self.audios.get(audio_key(audio))):
+                return self.audios[audio_key(audio)]
+            if self.files.get(filename):
+                return filename
+            if not key or (size is None and tools.REPLACE_CHAR in filename):
+                return None
+            existing = self.names.get(key)
+            if existing and self.files.get(existing) and (size is None or self.files[existing] == size):
+                return existing
+        return None
+
+    def add(self, audio, filename):
+        """Record downloaded audio file."""
+        filename = os.path.basename(filename)
+        size = os.path.getsize(os.path.join(self.directory, filename))
+        with self.lock:
+            self.files[filename] = size
+            self.names[normalize_name(filename)] = filename
+            self.audios[audio_key(audio)] = filename
+            self.unsaved += 1
+            save = self.unsaved >= self.save_every
+        if save:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.unsaved:
+                return
+            # Created before the index is replaced, so that later writes in place do not change directory
+            fd = os.open(self.mtime_filename, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                tmp = self.filename + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump({'files': self.files, 'audios': self.audios}, f)
+                os.replace(tmp, self.filename)
+                # Replacing the index changes directory, so its modification time is taken after that.
+                # Fixed width and in place, a stale or torn value only makes the next load scan.
+                os.pwrite(fd, b'%020d' % os.stat(self.directory).st_mtime_ns, 0)
+            finally:
+                os.close(fd)
+            self.unsaved = 0
@@ -0,0 +1,122 @@
+import collections
+import json
+import os
+import threading
+import time
+import index
+
+
+JOURNAL_FILENAME = '.pyvkmusic_journal.ndjson'
+STATES = ('queued', 'started', 'done', 'failed')
+
+
+class JournalState(object):
+    """
+    Last known state of every audio in a journal.
+
+    :ivar collections.OrderedDict entries: audio key to its last entry, in order audios were first queued.
+    :ivar bool listed: whether the run that wrote the journal got through its whole listing.
+    """
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.listed = False
+
+    def add(self, entry):
+        if entry.get('event') == 'listed':
+            self.listed = True
+        elif entry.get('state') in STATES:
+            self.entries.setdefault(entry['key'], dict()).update(entry)
+
+    def done(self):
+        """:return set: keys of downloaded audios."""
+        return set(key for key, entry in self.entries.items() if entry['state'] == 'done')
+
+    def unfinished(self):
+        """:return list: keys of audios queued, started or failed, in journal order."""
+        return [key for key, entry in self.entries.items() if entry['state'] != 'done']
+
+
+def replay(filename):
+    """
+    Read journal. A line cut short by a crash is ignored.
+
+    :return JournalState: state of audios, empty if there is no journal.
+    """
+    state = JournalState()
+    if not os.path.exists(filename):
+        return state
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                state.add(json.loads(line))
+            except ValueError:
+                continue
+    return state
+
+
+class DownloadJournal(object):
+    """
+    Append-only log of download states: queued, started, done with size and checksum, failed with reason.
+
+    Lines are written as they come and fsync'ed every sync_every lines or sync_interval seconds,
+    whichever comes first, and on close. Losing the last unsynced lines only means some audios are
+    downloaded again.
+    """
+    def __init__(self, filename, sync_every=100, sync_interval=1.0):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.file = open(filename, 'a', encoding='utf-8')
+        self.unsynced = 0
+        self.synced = time.monotonic()
+
+    def write(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.monotonic() - self.synced >= self.sync_interval:
+                self._sync()
+
+    def record(self, audio, state, **fields):
+        """
+        :param dict audio: audio state is recorded for.
+        :param str state: one of STATES.
+        :param fields: size and checksum for done, error for failed.
+        """
+        entry = {'key': index.audio_key(audio), 'state': state, 'time': time.time()}
+        entry.update(fields)
+        self.write(entry)
+
+    def listed(self):
+        """Record that whole listing was queued, so resume does not need to list again."""
+        self.write({'event': 'listed', 'time': time.time()})
+
+    def compact(self, state):
+        """Rewrite journal with only last entries of state."""
+        with self.lock:
+            self.file.close()
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for entry in state.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                if state.listed:
+                    f.write(json.dumps({'event': 'listed', 'time': time.time()}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.filename)
+            self.file = open(self.filename, 'a', encoding='utf-8')
+            self.unsynced = 0
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.unsynced:
+                self._sync()
+            self.file.close()
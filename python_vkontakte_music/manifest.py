@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import records
+
+
+class Entry(records.Audio):
+    """Audio with target filename, size and exists status."""
+    __slots__ = ('filename', 'size', 'exists', 'error')
+    fields = records.Audio.fields + __slots__
+    field_set = frozenset(fields)
+
+
+def make_entry(audio, filename, size=None, exists=False, error=None):
+    """
+    :param dict audio: audio as listed by API.
+    :param str filename: where audio is to be saved.
+    :return Entry: manifest entry.
+    """
+    entry = Entry(audio)
+    entry.filename = filename
+    entry.size = size
+    entry.exists = exists
+    entry.error = error
+    return entry
+
+
+def write_manifest(filename, entries):
+    """
+    Write manifest entries, one JSON object per line.
+
+    :return list: written entries.
+    """
+    written = list()
+    tmp = filename + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False, default=records.to_json))
+            f.write('\n')
+            written.append(entry)
+    os.replace(tmp, filename)
+    return written
+
+
+def read_manifest(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield Entry(json.loads(line))
+
+
+def shard_type(value):
+    """Parse shard like 2/4 into (2, 4)."""
+    index, _, count = value.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a shard like 1/4' % value)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('Shard %s is out of range' % value)
+    return index, count
+
+
+def select_shard(entries, index, count):
+    """
+    Split entries into count shards of about equal size in bytes.
+
+    Largest entries are given to the least loaded shard first, so every machine reading the same
+    manifest gets the same split. Entries of unknown size count as average ones.
+
+    :param int index: which shard to return, from 1.
+    :return list: entries of the shard, in manifest order.
+    """
+    entries = list(entries)
+    sizes = [entry['size'] for entry in entries if entry.get('size')]
+    average = sum(sizes) // len(sizes) if sizes else 1
+    weights = [entry.get('size') or average for entry in entries]
+    loads = [0] * count
+    selected = list()
+    for n in sorted(range(len(entries)), key=lambda n: (-weights[n], n)):
+        shard = loads.index(min(loads))
+        loads[shard] += weights[n]
+        if shard == index - 1:
+            selected.append(n)
+    return [entries[n] for n in sorted(selected)]
+
+
+def summarize(entries):
+    """:return dict: counts and sizes of all, existing, pending and unknown size entries."""
+    summary = {'audios': 0, 'bytes': 0, 'existing': 0, 'existing_bytes': 0, 'pending': 0, 'pending_bytes': 0,
+               'unknown_size': 0}
+    for entry in entries:
+        size = entry.get('size') or 0
+        summary['audios'] += 1
+        summary['bytes'] += size
+        if entry.get('exists'):
+            summary['existing'] += 1
+            summary['existing_bytes'] += size
+        else:
+            summary['pending'] += 1
+            summary['pending_bytes'] += size
+            if not entry.get('size'):
+                summary['unknown_size'] += 1
+    return summary
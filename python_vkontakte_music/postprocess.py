@@ -0,0 +1,279 @@
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import stats
+
+
+# Layer III bitrates in kbps by bitrate index, for MPEG 1 and MPEG 2 / 2.5
+BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG 1
+    2: (22050, 24000, 16000),  # MPEG 2
+    0: (11025, 12000, 8000),   # MPEG 2.5
+}
+# Trailing tags that may follow the last frame
+TRAILERS = (b'TAG', b'APETAGEX', b'LYRICSBEGIN')
+# Frames make_id3_tag writes for its fields, replacing ones file already has
+TAG_FRAMES = (('TPE1', 'artist'), ('TIT2', 'title'), ('TALB', 'album'), ('TLEN', 'duration'))
+
+
+def syncsafe(size):
+    """Encode size as ID3v2 syncsafe integer, 7 bits per byte."""
+    return bytes(((size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f))
+
+
+def unsyncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def text_frame(frame_id, text, version=3):
+    """ID3v2.3 or 2.4 text frame, UTF-16 with BOM."""
+    data = b'\x01' + text.encode('utf-16')
+    size = syncsafe(len(data)) if version == 4 else struct.pack('>I', len(data))
+    return frame_id.encode('ascii') + size + b'\x00\x00' + data
+
+
+def make_id3_tag(artist=None, title=None, album=None, duration=None, version=3, frames=()):
+    """
+    :param int duration: length in seconds.
+    :param int version: ID3v2 minor version, 3 or 4.
+    :param frames: raw frames of the same version to keep after the given fields.
+    :return bytes: ID3v2 tag with given fields.
+    """
+    data = b''
+    for frame_id, text in (('TPE1', artist), ('TIT2', title), ('TALB', album)):
+        if text:
+            data += text_frame(frame_id, text, version)
+    if duration:
+        data += text_frame('TLEN', str(int(duration) * 1000), version)
+    data += b''.join(frames)
+    return b'ID3' + bytes((version, 0, 0)) + syncsafe(len(data)) + data
+
+
+def id3_size(header):
+    """:return int: size of ID3v2 tag the file starts with, or 0."""
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    size = 10 + unsyncsafe(header[6:10])
+    if header[5] & 0x10:
+        size += 10  # footer
+    return size
+
+
+def read_frames(tag):
+    """
+    :param bytes tag: whole ID3v2 tag.
+    :return list: (frame id, raw frame) pairs of ID3v2.3 or 2.4 tag. Empty for other versions and for
+        unsynchronised tags, whose frames can not be copied as they are.
+    """
+    version, flags = tag[3], tag[5]
+    if version not in (3, 4) or flags & 0x80:
+        return list()
+    end = min(len(tag), 10 + unsyncsafe(tag[6:10]))
+    position = 10
+    if flags & 0x40:
+        # Extended header, its size does not include itself in 2.3
+        position += unsyncsafe(tag[10:14]) if version == 4 else 4 + struct.unpack('>I', tag[10:14])[0]
+    frames = list()
+    while position + 10 <= end:
+        frame_id = tag[position:position + 4]
+        if not frame_id.isalnum():
+            break  # padding
+        size = tag[position + 4:position + 8]
+        size = 10 + (unsyncsafe(size) if version == 4 else struct.unpack('>I', size)[0])
+        if position + size > end:
+            break
+        frames.append((frame_id.decode('ascii'), tag[position:position + size]))
+        position += size
+    return frames
+
+
+def write_tag(filename, tags):
+    """
+    Put ID3 tag at the beginning of file. Frames of ID3v2 tag file already has, like cover art,
+    track number or year, are kept, except the ones given tags replace.
+
+    :param dict tags: make_id3_tag arguments.
+    """
+    tmp = filename + '.tag'
+    with open(filename, 'rb') as src:
+        header = src.read(10)
+        size = id3_size(header)
+        frames = read_frames(header + src.read(size - 10)) if size else list()
+        replaced = set(frame_id for frame_id, field in TAG_FRAMES if tags.get(field))
+        frames = [frame for frame_id, frame in frames if frame_id not in replaced]
+        version = header[3] if frames else 3
+        src.seek(size)
+        with open(tmp, 'wb') as dst:
+            dst.write(make_id3_tag(version=version, frames=frames, **tags))
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp, filename)
+
+
+def frame_length(data, position):
+    """:return int: length of MPEG Layer III frame starting at position, or None if there is no valid header."""
+    if position + 4 > len(data) or data[position] != 0xff:
+        return None
+    b1, b2 = data[position + 1], data[position + 2]
+    version = (b1 >> 3) & 3
+    if b1 & 0xe0 != 0xe0 or version == 1 or (b1 >> 1) & 3 != 1:
+        return None
+    bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 3
+    if bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    return (144 if version == 3 else 72) * bitrate // sample_rate + ((b2 >> 1) & 1)
+
+
+def find_frames(data, start, limit):
+    """
+    :return int: position of the first frame followed by another one within limit bytes from start,
+        so a stray 0xff is not taken for a frame, or None.
+    """
+    end = min(len(data), start + limit)
+    position = start
+    while 0 <= position < end:
+        length = frame_length(data, position)
+        if length and frame_length(data, position + length):
+            return position
+        position = data.find(b'\xff', position + 1, end)
+    return None
+
+
+def validate_mp3(filename, expected_size=None):
+    """
+    Check that file is a complete MP3: its size is as expected and MPEG frames follow one another
+    from the first one to the end of file, except for trailing tags and less than a frame of tail.
+
+    :param int expected_size: size file should have, if known.
+    :return str: what is wrong with file, or None if it is valid.
+    """
+    size = os.path.getsize(filename)
+    if expected_size and size != expected_size:
+        return 'Size is {}, expected {}'.format(size, expected_size)
+    if not size:
+        return 'File is empty'
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = find_frames(data, id3_size(data[:10]), 64 * 1024)
+        if position is None:
+            return 'No MPEG frames found'
+        frames = 0
+        while position < size:
+            length = frame_length(data, position)
+            if length is None:
+                if data[position:position + 11].startswith(TRAILERS):
+                    break
+                return 'Lost frame sync at byte {} after {} frames'.format(position, frames)
+            if position + length > size:
+                break
+            frames += 1
+            position += length
+    return None
+
+
+def process_file(filename, tags=None, expected_size=None, verify=True, checksum='md5'):
+    """
+    Validate, tag and checksum downloaded file. Runs in worker process.
+
+    :param dict tags: artist, title, album and duration to write as ID3 tag. Not tagged if None.
+    :return dict: filename, error, whether file was tagged, checksum and seconds each step took.
+    """
+    import hashlib
+    result = {'filename': filename, 'error': None, 'tagged': False, 'checksum': None, 'seconds': dict()}
+    started = time.perf_counter()
+    if verify:
+        result['error'] = validate_mp3(filename, expected_size)
+        result['seconds']['verify'] = time.perf_counter() - started
+        if result['error']:
+            return result
+    if tags is not None:
+        started = time.perf_counter()
+        write_tag(filename, tags)
+        result['tagged'] = True
+        result['seconds']['tag'] = time.perf_counter() - started
+    if checksum:
+        started = time.perf_counter()
+        digest = hashlib.new(checksum)
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        result['checksum'] = digest.hexdigest()
+        result['seconds']['checksum'] = time.perf_counter() - started
+    return result
+
+
+class PostProcessor(object):
+    """
+    Process pool post-processing downloaded files while downloads go on.
+
+    Downloaders submit finished files and go on with the next download. Up to max_pending files wait
+    in the queue between the stages, submit blocks only when it is full.
+
+    :param int workers: processes. Default is number of CPUs.
+    :param bool tag: write ID3 tags from audio metadata.
+    :param bool verify: validate files.
+    :param on_done: function called with audio and result dict of process_file.
+    """
+    def __init__(self, workers=None, tag=False, verify=True, on_done=None, max_pending=None):
+        from concurrent.futures import ProcessPoolExecutor
+        workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(workers)
+        self.semaphore = threading.BoundedSemaphore(max_pending or workers * 16)
+        self.tag = tag
+        self.verify = verify
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.tagged = 0
+        self.errors = list()
+
+    def submit(self, audio, filename, album=None, on_done=None):
+        """
+        :param dict audio: downloaded audio.
+        :param str album: album title to tag with.
+        :param on_done: function called with audio and result instead of the one pool is made with.
+        """
+        tags = None
+        if self.tag:
+            tags = {'artist': audio.get('artist'), 'title': audio.get('title'), 'album': album,
+                    'duration': audio.get('duration')}
+        self.semaphore.acquire()
+        try:
+            future = self.executor.submit(process_file, filename, tags, audio.get('size'), self.verify)
+        except:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(lambda future: self._done(audio, filename, future, on_done or self.on_done))
+
+    def _done(self, audio, filename, future, on_done):
+        self.semaphore.release()
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {'filename': filename, 'error': str(e) or e.__class__.__name__, 'tagged': False,
+                      'checksum': None, 'seconds': dict()}
+        for step, seconds in result['seconds'].items():
+            stats.registry.record('post', step, seconds)
+        with self.lock:
+            self.processed += 1
+            self.tagged += result['tagged']
+            if result['error']:
+                self.errors.append((filename, result['error']))
+        if on_done:
+            on_done(audio, result)
+
+    def close(self):
+        """Wait until every submitted file is processed."""
+        self.executor.shutdown(wait=True)
+
+    def summary(self):
+        print('Post-processed {} files, {} tagged, {} invalid.'.format(self.processed, self.tagged, len(self.errors)))
+        for filename, error in self.errors:
+            print('Invalid: {} Error: {}'.format(filename, error))
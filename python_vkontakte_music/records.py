@@ -0,0 +1,123 @@
+class Record(object):
+    """
+    Compact item of an API listing, readable like the dict it is made of.
+
+    Known fields are kept in slots, others in extra dict, which is None if there are none.
+    Fields that are missing from the response, or null, are absent for item access.
+    """
+    __slots__ = ('extra',)
+    fields = ()
+    field_set = frozenset()
+
+    def __init__(self, data):
+        for name in self.fields:
+            setattr(self, name, data.get(name))
+        if self.field_set.issuperset(data):
+            self.extra = None
+        else:
+            self.extra = dict((key, value) for key, value in data.items() if key not in self.field_set)
+
+    def __getitem__(self, key):
+        if key in self.field_set:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.field_set:
+            setattr(self, key, value)
+        elif self.extra is None:
+            self.extra = {key: value}
+        else:
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [name for name in self.fields if getattr(self, name) is not None]
+        if self.extra:
+            keys.extend(self.extra)
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        return dict((key, self[key]) for key in self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.to_dict())
+
+
+class Audio(Record):
+    __slots__ = fields = ('id', 'owner_id', 'artist', 'title', 'duration', 'url', 'album_id', 'lyrics_id', 'genre_id',
+                          'date')
+    field_set = frozenset(fields)
+
+
+class Album(Record):
+    __slots__ = fields = ('id', 'owner_id', 'title')
+    field_set = frozenset(fields)
+
+
+class Friend(Record):
+    __slots__ = fields = ('id', 'first_name', 'last_name', 'screen_name')
+    field_set = frozenset(fields)
+
+
+class Group(Record):
+    __slots__ = fields = ('id', 'name', 'screen_name', 'is_closed', 'type')
+    field_set = frozenset(fields)
+
+
+RECORD_TYPES = {
+    'audio.get': Audio,
+    'audio.getById': Audio,
+    'audio.search': Audio,
+    'audio.getAlbums': Album,
+    'friends.get': Friend,
+    'groups.get': Group,
+}
+
+
+def make_records(method, items):
+    """
+    :param str method: API method items were listed with.
+    :param items: iterable of item dicts.
+    :return: iterable of records, or items as they are if method has no record type.
+    """
+    record = RECORD_TYPES.get(method)
+    if record is None:
+        return items
+    return (item if isinstance(item, Record) else record(item) for item in items)
+
+
+def to_json(item):
+    """json.dumps default function serializing records as dicts."""
+    if isinstance(item, Record):
+        return item.to_dict()
+    raise TypeError('%r is not JSON serializable' % item)
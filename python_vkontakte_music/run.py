@@ -1,9 +1,11 @@
 def main():
     import argparse
-    import tools, actions, vkontakte
+    import importlib
+    import sys
+    import tools, actions, vkontakte, cache, stats
 
     parser = argparse.ArgumentParser('Python Vkontakte Music Downloader')
-    tools.ActionBase(parser)
+    tools.ActionBase(parser, sys.argv[1:])
     args = vars(parser.parse_args())
 
     nocreds_message = 'Specify ether login and password, or credentials file only.'
@@ -13,20 +15,45 @@ def main():
     if args['credentials']:
         args['login'], args['pass'] = list(args.pop('credentials'))
 
+    login, password = args.pop('login'), args.pop('pass')
     try:
-        args['access_token'] = tools.get_access_token(args.pop('login'), args.pop('pass'))
+        token = tools.get_token(login, password)
     except tools.CredentialsError:
         parser.error('Invalid login or password')
 
     action = args.pop('action_instance')
     action_name = args.pop('action')
-    action.client = vkontakte.VkontakteClient(args.pop('access_token'), args.pop('version'))
+    action.prefetch = args.pop('prefetch')
+    action.cache_file = args.pop('cache_file')
+    action.refresh = args.pop('refresh')
+    if args.pop('cache') or action.refresh:
+        action.cache = cache.LibraryCache(action.cache_file)
+    pool_size = max(args.pop('pool_size'), (args.get('jobs') or 1) * (args.get('segments') or 1), action.prefetch)
+    timeout = (args.pop('connect_timeout'), args.pop('read_timeout'))
+    action.client = vkontakte.VkontakteClient(token['access_token'], args.pop('version'),
+                                              pool_size=pool_size, rate=args.pop('rate'), user_id=token['user_id'],
+                                              reauth=lambda: tools.refresh_access_token(login, password)['access_token'],
+                                              timeout=timeout)
+
+    print_stats = args.pop('stats')
+    stats_file = args.pop('stats_file')
+    stats_callback = args.pop('stats_callback')
+    if stats_callback:
+        module_name, _, function_name = stats_callback.partition(':')
+        stats.registry.add_callback(getattr(importlib.import_module(module_name), function_name))
 
     try:
         return action.run(**args)
     except vkontakte.VkontakteError as e:
         print('[Error]', '[Code:%s]' % e.error_code, '[Message: %s]' % e.error_msg)
         exit(1)
+    finally:
+        if print_stats or stats_file:
+            extra = {'connections': action.client.connection_stats()}
+            if print_stats:
+                stats.registry.print_summary(extra)
+            if stats_file:
+                stats.registry.write_json(stats_file, extra)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,118 @@
+import bisect
+import json
+import threading
+import time
+
+
+# Upper bounds of latency histogram buckets, seconds
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """:return float: upper bound of the bucket holding p-th percentile."""
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class Stats(object):
+    """
+    Counters, byte totals and latency histograms per (name, key), e.g. ('api', 'audio.get')
+    or ('download', 'cs1-2.vk.me').
+
+    Callbacks added with add_callback are called with every recorded event dict.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = dict()
+        self.bytes = dict()
+        self.histograms = dict()
+        self.callbacks = list()
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def record(self, name, key, seconds=None, nbytes=0, count=1):
+        """
+        :param str name: what is measured: api, list, download, disk, output, throttle...
+        :param str key: method, host or format.
+        :param float seconds: latency to add to histogram.
+        :param int nbytes: bytes transferred.
+        :param int count: how many things happened.
+        """
+        with self.lock:
+            self.counters[name, key] = self.counters.get((name, key), 0) + count
+            if nbytes:
+                self.bytes[name, key] = self.bytes.get((name, key), 0) + nbytes
+            if seconds is not None:
+                if (name, key) not in self.histograms:
+                    self.histograms[name, key] = Histogram()
+                self.histograms[name, key].add(seconds)
+        if self.callbacks:
+            event = {'name': name, 'key': key, 'seconds': seconds, 'bytes': nbytes, 'count': count}
+            for callback in self.callbacks:
+                callback(event)
+
+    def summary(self):
+        with self.lock:
+            keys = sorted(set(self.counters) | set(self.histograms))
+            summary = dict()
+            for name, key in keys:
+                item = {'count': self.counters.get((name, key), 0), 'bytes': self.bytes.get((name, key), 0)}
+                if (name, key) in self.histograms:
+                    item['latency'] = self.histograms[name, key].summary()
+                summary.setdefault(name, dict())[key] = item
+        return {'elapsed': time.time() - self.started, 'stats': summary}
+
+    def print_summary(self, extra=None):
+        summary = self.summary()
+        print('Run time: {:.1f}s'.format(summary['elapsed']))
+        for name in sorted(summary['stats']):
+            print('[{}]'.format(name))
+            for key, item in sorted(summary['stats'][name].items()):
+                line = '  {:<32} count={}'.format(key, item['count'])
+                if item['bytes']:
+                    line += ' bytes={}'.format(item['bytes'])
+                if 'latency' in item:
+                    line += ' mean={0[mean]:.3f}s p50<={0[p50]:.3f}s p99<={0[p99]:.3f}s max={0[max]:.3f}s'.format(
+                        item['latency'])
+                print(line)
+        for key, value in sorted((extra or dict()).items()):
+            print('{}: {}'.format(key, value))
+
+    def write_json(self, filename, extra=None):
+        summary = self.summary()
+        if extra:
+            summary.update(extra)
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+registry = Stats()
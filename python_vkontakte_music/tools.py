@@ -2,63 +2,139 @@
 from __future__ import print_function
 import argparse
 
+import collections
+import csv
+import functools
+import io
+import itertools
+import json
+import operator
 import os
-import requests
 import string
-from urllib.request import urlretrieve
+import sys
+import threading
+import time
+import cache
+import records
+import stats
 import vkontakte
+from urllib.parse import urlparse
 
 
 ACCESS_TOKEN_FILENAME = '.access_token'
 APPLICATION_ID = '5091851'
 SCOPE = ['audio', 'groups', 'friends']
 REPLACE_CHAR = '#'
+OUTPUT_FORMATS = ('text', 'ndjson', 'csv', 'tsv')
 VALID_CHARS = set(string.printable) - set('\*:"<>|/')
 VALID_CHARS = VALID_CHARS.union(set((chr(i) for i in range(ord('А'), ord('я')+1))))
 
 
+PART_SUFFIX = '.part'
+# Sidecar of a preallocated part, holding how many of its bytes are downloaded
+PROGRESS_SUFFIX = '.progress'
+PROGRESS_INTERVAL = 0.25
+DOWNLOAD_BUFFER_SIZE = 256 * 1024
+# Smallest byte range worth its own connection in segmented downloads
+SEGMENT_MIN_SIZE = 4 * 1024 * 1024
+# Audios to ask with one audio.getById call
+GET_BY_ID_LIMIT = 100
+
+
 class CredentialsError(Exception): pass
 
 
-def check_access_token_file():
-    if os.path.exists(ACCESS_TOKEN_FILENAME):
-        with open(ACCESS_TOKEN_FILENAME, 'r') as f:
-            access_token = f.read()
-            try:
-                vkontakte.VkontakteClient(access_token).call('audio.get')
-            except:
-                return None
-            else:
-                return access_token
-    else:
+class IncompleteDownload(Exception): pass
+
+
+class RangeIgnored(Exception): pass
+
+
+# Consider token expired this many seconds before it actually expires
+TOKEN_EXPIRY_MARGIN = 60
+
+
+def load_access_token_file():
+    """
+    :return dict: saved access_token, user_id and expires_at (0 means never expires, None means unknown),
+        or None if nothing is saved.
+    """
+    if not os.path.exists(ACCESS_TOKEN_FILENAME):
+        return None
+    with open(ACCESS_TOKEN_FILENAME, 'r') as f:
+        data = f.read().strip()
+    if not data:
         return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        # Plain token saved by older versions
+        return {'access_token': data, 'user_id': None, 'expires_at': None}
+
+
+def check_access_token(token):
+    """
+    :param dict token: token loaded by load_access_token_file.
+    :return bool: whether token is usable. Network is used only if token expiry is unknown.
+    """
+    if token['expires_at'] is None:
+        try:
+            vkontakte.VkontakteClient(token['access_token']).call('audio.get', count=1)
+        except:
+            return False
+        return True
+    return token['expires_at'] == 0 or token['expires_at'] - TOKEN_EXPIRY_MARGIN > time.time()
 
 
-def save_access_token_file(access_token):
+def save_access_token_file(access_token, user_id=None, expires_in=0):
+    token = {
+        'access_token': access_token,
+        'user_id': int(user_id) if user_id else None,
+        'expires_at': time.time() + int(expires_in) if int(expires_in) else 0,
+    }
     with open(ACCESS_TOKEN_FILENAME, 'w') as f:
-        f.write(access_token)
+        os.chmod(ACCESS_TOKEN_FILENAME, 0o600)
+        json.dump(token, f)
+    return token
 
 
 def retrieve_access_token(login, password):
+    """:return tuple: access_token, user_id, expires_in."""
     try:
-        return vkontakte.auth(login, password, APPLICATION_ID, SCOPE)[0]
+        return vkontakte.auth(login, password, APPLICATION_ID, SCOPE)
     except ValueError:
         raise CredentialsError('Invalid login or password.')
 
 
-def get_access_token(login, password):
-    access_token = check_access_token_file()
-    if not access_token:
-        access_token = retrieve_access_token(login, password)
-        save_access_token_file(access_token)
-    return access_token
+def refresh_access_token(login, password):
+    """Authorize again and save new token. :return dict: saved token."""
+    return save_access_token_file(*retrieve_access_token(login, password))
+
+
+def get_token(login, password):
+    """
+    :return dict: saved token if it is still valid, new one otherwise.
+    """
+    token = load_access_token_file()
+    if token and check_access_token(token):
+        return token
+    return refresh_access_token(login, password)
 
 
 class ActionBase(object):
     subaction_required = True
     action_name = None
+    prefetch = 4
+    cache = None
+    cache_file = None
+    refresh = False
+    search_cache = None
 
-    def __init__(self, parser):
+    def __init__(self, parser, argv=None):
+        """
+        :param list argv: command line arguments. If given, only the parser of selected subaction is
+            filled in, others are left empty.
+        """
         # apply arguments only if function was defined in class (do not use parents apply_arguments)
         if 'apply_arguments' in self.__class__.__dict__:
             self.apply_arguments(parser)
@@ -68,10 +144,29 @@ class ActionBase(object):
             if self.subaction_required:
                 subparsers.dest = 'action'
                 subparsers.required = True
+            selected, argv = self.select_subaction(subactions, argv)
             for action_class in subactions:
                 parser = subparsers.add_parser(action_class.action_name)
-                action = action_class(parser)
-                parser.set_defaults(action_instance=action)
+                if selected is None or action_class is selected:
+                    action = action_class(parser, argv)
+                    parser.set_defaults(action_instance=action)
+
+    @staticmethod
+    def select_subaction(subactions, argv):
+        """
+        Find which subaction argv selects.
+
+        :return tuple: subaction class and arguments after its name. Class is None if there is no
+            single candidate, then every subaction has to be built.
+        """
+        if argv is None:
+            return None, None
+        names = dict((action_class.action_name, action_class) for action_class in subactions)
+        found = [(n, arg) for n, arg in enumerate(argv) if arg in names]
+        if not found or len(set(arg for n, arg in found)) > 1:
+            return None, None
+        n, arg = found[0]
+        return names[arg], argv[n + 1:]
 
     @classmethod
     def get_subactions(cls):
@@ -91,6 +186,20 @@ class ActionBase(object):
         group.add_argument('-p', '--pass', help='User password.')
 
         parser.add_argument('-V', '--version', help='Which API version to use. Default is 5.37.', default='5.37')
+        parser.add_argument('--prefetch', type=int, default=4, help='Listing requests to make concurrently. Default is 4.')
+        parser.add_argument('--rate', type=float, default=3, help='API requests per second. Default is 3.')
+        parser.add_argument('--cache', action='store_true', help='Serve listings from local cache, syncing only new items.')
+        parser.add_argument('--refresh', action='store_true', help='Fetch full listings into local cache.')
+        parser.add_argument('--cache_file', default=cache.CACHE_FILENAME, help='Cache file. Default is %s.' % cache.CACHE_FILENAME)
+        parser.add_argument('--stats', action='store_true', help='Print run statistics at exit.')
+        parser.add_argument('--stats_file', help='Write run statistics as JSON to this file at exit.')
+        parser.add_argument('--stats_callback', help='Function "module:name" called with every statistics event.')
+        parser.add_argument('--pool_size', type=int, default=10, help='Connections to keep open per host. Default is 10.')
+        parser.add_argument('--connect_timeout', type=float, default=vkontakte.DEFAULT_TIMEOUT[0],
+                            help='Seconds to wait for connection. Default is %s.' % vkontakte.DEFAULT_TIMEOUT[0])
+        parser.add_argument('--read_timeout', type=float, default=vkontakte.DEFAULT_TIMEOUT[1],
+                            help='Seconds to wait for response data, after which request is retried. '
+                                 'Default is %s.' % vkontakte.DEFAULT_TIMEOUT[1])
 
     def add_print_part_argument(self, parser, what, *choices):
         additional = list()
@@ -101,52 +210,240 @@ class ActionBase(object):
         choices += additional
         parser.add_argument('--print_part', choices=choices, help='Which %s part to show.' % what)
 
+    def add_format_argument(self, parser):
+        parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS, default='text',
+                            help='Output format. Default is text.')
+
     def add_limit_argument(self, parser, what, action):
         parser.add_argument('--limit', type=int, help='%s only first N %s.' % (action.capitalize(), what))
 
     def add_id_argument(self, parser, what, action):
         group = parser.add_mutually_exclusive_group()
-        group.add_argument('--id_file', type=argparse.FileType('r'), help='File with list of %s ids to %s.' % (what, action))
+        group.add_argument('--id_file', type=argparse.FileType('r'),
+                           help='File with %s ids to %s, one per line, as id or ownerid_id.' % (what, action))
         group.add_argument('--id', type=int, nargs='+', help='List of %s ids to %s.' % (what, action))
 
     def run(self, *args, **kwargs):
         print(self.__class__.__name__, args, kwargs)
 
-    def list_items(self, method, limit=None, run_full=True,  **kwargs):
-        """Get a full list of items"""
-        kwargs['count'] = 100
+    def list_items(self, method, limit=None, run_full=True, page_size=100, prefetch=None, **kwargs):
+        """
+        Get a full list of items.
+
+        Pages after the first one are requested with execute, up to vkontakte.EXECUTE_LIMIT pages per request.
+        Up to prefetch such requests are made concurrently, items are still yielded in order.
+        Items of known methods are yielded as records.RECORD_TYPES records.
+
+        :param int prefetch: how many execute requests to keep in flight. Default is self.prefetch.
+        """
+        if prefetch is None:
+            prefetch = self.prefetch
+        started = time.perf_counter()
+        items = self._list_items(method, limit, run_full, page_size, prefetch, kwargs)
+        n = 0
+        try:
+            for item in records.make_records(method, items):
+                yield item
+                n += 1
+        finally:
+            items.close()
+            stats.registry.record('list', method, time.perf_counter() - started, count=n)
+
+    def _list_items(self, method, limit, run_full, page_size, prefetch, kwargs):
+        kwargs['count'] = page_size
         if limit and limit < kwargs['count']:
             kwargs['count'] = limit
         first = self.client.call(method, **kwargs)
         total = first['count']
-        offset = len(first['items'])
+        if limit:
+            total = min(total, limit)
         n = 0
-        items = first['items']
-        while offset <= total:
-            for item in items:
-                if limit and n == limit:
-                    raise StopIteration()
-                yield item
-                n += 1
-            if not run_full:
-                raise StopIteration()
-            if offset == total:
-                raise StopIteration()
-            kwargs['offset'] = offset
-            items = self.client.call(method, **kwargs)['items']
-            offset += len(items)
+        for item in first['items']:
+            if n == total:
+                return
+            yield item
+            n += 1
+        if not run_full:
+            return
+
+        def fetch(offsets):
+            with self.client.batch() as batch:
+                calls = [batch.call(method, offset=offset, **kwargs) for offset in offsets]
+            return [call.result()['items'] for call in calls]
+
+        offsets = list(range(len(first['items']), total, kwargs['count']))
+        chunks = [offsets[start:start + vkontakte.EXECUTE_LIMIT]
+                  for start in range(0, len(offsets), vkontakte.EXECUTE_LIMIT)]
+        if prefetch > 1 and len(chunks) > 1:
+            pages = self._prefetch_pages(fetch, chunks, prefetch)
+        else:
+            pages = (page for chunk in chunks for page in fetch(chunk))
+        try:
+            for items in pages:
+                for item in items:
+                    if n == total:
+                        return
+                    yield item
+                    n += 1
+        finally:
+            pages.close()
+
+    def _prefetch_pages(self, fetch, chunks, prefetch):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(prefetch)
+        chunks = iter(chunks)
+        in_flight = collections.deque()
+        try:
+            for chunk in itertools.islice(chunks, prefetch):
+                in_flight.append(executor.submit(fetch, chunk))
+            while in_flight:
+                pages = in_flight.popleft().result()
+                for chunk in itertools.islice(chunks, 1):
+                    in_flight.append(executor.submit(fetch, chunk))
+                for page in pages:
+                    yield page
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def sync_library(self, method, page_size=100, **kwargs):
+        """
+        Update cached copy of a listing.
+
+        Without cached copy, or with self.refresh, the full listing is fetched. Otherwise pages are fetched
+        from the newest one until a known item is met. If counts do not add up after that (items were removed
+        or reordered), the full listing is fetched again.
+
+        :return tuple: all items and new items, both newest first.
+        """
+        scope = cache.make_scope(method, kwargs)
+        owner_id = int(kwargs.get('owner_id') or 0)
+        cached = None if self.refresh else self.cache.get(scope)
+        if cached is not None:
+            cached = list(records.make_records(method, cached))
+        if cached is None:
+            items = list(self.list_items(method, page_size=page_size, **kwargs))
+            self.cache.replace(scope, owner_id, items)
+            return items, items
+        known = set(item['id'] for item in cached)
+        new = list()
+        offset = 0
+        while True:
+            page = self.client.call(method, count=page_size, offset=offset, **kwargs)
+            total = page['count']
+            for item in records.make_records(method, page['items']):
+                if item['id'] in known:
+                    break
+                new.append(item)
+            else:
+                offset += len(page['items'])
+                if page['items'] and offset < total:
+                    continue
+            break
+        if len(new) + len(cached) != total:
+            items = list(self.list_items(method, page_size=page_size, **kwargs))
+            self.cache.replace(scope, owner_id, items)
+            return items, [item for item in items if item['id'] not in known]
+        if new:
+            self.cache.prepend(scope, owner_id, new)
+        return new + cached, new
+
+    def list_library(self, method, limit=None, **kwargs):
+        """Same as list_items, but served from self.cache after incremental sync if cache is enabled."""
+        if self.cache is None:
+            return self.list_items(method, limit=limit, **kwargs)
+        items = self.sync_library(method, **kwargs)[0]
+        return items[:limit] if limit else items
+
+    def search_items(self, method, limit=None, ttl=None, **kwargs):
+        """
+        Same as list_items, but results are kept in search cache for ttl seconds, keyed by method and parameters.
+        Search cache is kept on disk in cache file, even if library cache is not enabled, so results outlive the run.
+        With self.refresh, cached results are not used.
+
+        :param float ttl: default is cache.SEARCH_TTL.
+        :return list: found items.
+        """
+        if self.search_cache is None:
+            self.search_cache = cache.SearchCache(self.cache or cache.LibraryCache(self.cache_file or cache.CACHE_FILENAME))
+        if ttl is not None:
+            self.search_cache.ttl = ttl
+        key = cache.make_scope(method, dict(kwargs, limit=limit))
+        items = None if self.refresh else self.search_cache.get(key)
+        if items is None:
+            items = list(self.list_items(method, limit=limit, **kwargs))
+            self.search_cache.put(key, items)
+            stats.registry.record('search', 'miss')
+        else:
+            stats.registry.record('search', 'hit')
+        return items
+
+    def list_by_ids(self, ids, owner_id=None, limit=None, batch_size=GET_BY_ID_LIMIT, prefetch=None):
+        """
+        Get audios by ids, streamed from any iterable.
+
+        Ids are resolved with audio.getById in batches of batch_size, up to vkontakte.EXECUTE_LIMIT batches
+        per execute request, with up to prefetch such requests in flight. Audios are yielded in order of ids
+        as they arrive, so memory use does not depend on number of ids. Missing audios are skipped.
+
+        :param ids: audio ids, or "<owner_id>_<audio_id>" strings.
+        :param int owner_id: owner of audios given by plain ids. Default is current user.
+        """
+        if prefetch is None:
+            prefetch = self.prefetch
+        owner_id = owner_id or self.client.user_id or self.client.call('users.get')[0]['id']
+        keys = (str(id) if '_' in str(id) else '{}_{}'.format(owner_id, id) for id in ids)
+        chunks = iter_chunks(iter_chunks(keys, batch_size), vkontakte.EXECUTE_LIMIT)
+
+        def fetch(chunk):
+            with self.client.batch() as batch:
+                calls = [batch.call('audio.getById', audios=','.join(keys)) for keys in chunk]
+            return [call.result() for call in calls]
+
+        if prefetch > 1:
+            pages = self._prefetch_pages(fetch, chunks, prefetch)
+        else:
+            pages = (page for chunk in chunks for page in fetch(chunk))
+        started = time.perf_counter()
+        n = 0
+        try:
+            for items in pages:
+                for item in records.make_records('audio.getById', items):
+                    if n == limit:
+                        return
+                    yield item
+                    n += 1
+        finally:
+            pages.close()
+            stats.registry.record('list', 'audio.getById', time.perf_counter() - started, count=n)
 
     def process_id_argument(self, kwargs):
-        if kwargs.get('id_file', None):
-            kwargs['id'] = from_ids_file(kwargs.pop('id_file'))
+        """
+        Pop id and id_file arguments.
+
+        :return: iterable of audio ids, read from id file lazily, or None if no ids are given.
+        """
+        id_file = kwargs.pop('id_file', None)
         id = kwargs.pop('id', None)
-        if id:
-            kwargs['audio_ids'] = ','.join(map(str, id))
+        if id_file:
+            return from_ids_file(id_file)
+        return id or None
+
 
+class _FilterTable(dict):
+    """str.translate table replacing invalid symbols, filled in on first use of each symbol."""
+    def __missing__(self, code):
+        value = code if chr(code) in VALID_CHARS else REPLACE_CHAR
+        self[code] = value
+        return value
 
+
+_FILTER_TABLE = _FilterTable()
+
+
+@functools.lru_cache(maxsize=8192)
 def filter_text(text):
     """Remove invalid symbols from string"""
-    return ''.join(c if c in VALID_CHARS else REPLACE_CHAR for c in text.strip())
+    return text.strip().translate(_FILTER_TABLE)
 
 
 def filter_audio_name(artist, title):
@@ -163,8 +460,40 @@ def make_audio_name(artist, title, valid_name=True, sep='-'):
     :return str: formatted audio name.
     """
     if valid_name:
-        artist, title = filter_audio_name(artist, title)
-    return artist + ' %s ' % sep + title
+        artist = filter_text(artist[:175])
+        title = filter_text(title[:175])
+    return '%s %s %s' % (artist, sep, title)
+
+
+_compiled_print_parts = dict()
+
+
+def compile_print_part(config, print_part=None):
+    """
+    Compile print config into (key, getter) pairs of selected parts.
+    Compiled getters are cached per config and print_part.
+
+    :param list config: print config.
+    :param str print_part: which part from config to get.
+    :return list: (key, function) pairs, functions get formatted value from item.
+    """
+    cache_key = (id(config), print_part)
+    cached = _compiled_print_parts.get(cache_key)
+    if cached is not None and cached[0] is config:
+        return cached[1]
+    parts = set(print_part.split('+')) if print_part is not None else None
+    getters = list()
+    for config_item in config:
+        key = list(config_item)[0]
+        options = config_item[key]
+        if parts is not None and key not in parts:
+            continue
+        getter = options.get('getter') or operator.itemgetter(options.get('key', key))
+        if 'format' in options:
+            getter = (lambda get, format: lambda d: format(get(d)))(getter, options['format'])
+        getters.append((key, getter))
+    _compiled_print_parts[cache_key] = (config, getters)
+    return getters
 
 
 def print_part_format(d, config, print_part=None):
@@ -174,26 +503,26 @@ def print_part_format(d, config, print_part=None):
     :param str print_part: which part from config to add to formatted string.
     :return str: formatted string.
     """
-    config_dict = dict()
-    keys_list = list()
-    for config_item in config:
-        key = list(config_item)[0]
-        config_dict[key] = config_item[key]
-        keys_list.append(key)
-    if print_part is not None:
-        print_part = set(print_part.split('+'))
-    else:
-        print_part = set(config_dict)
-    format = list()
-    for key in keys_list:
-        if key in print_part:
-            if 'getter' in config_dict[key]:
-                value = config_dict[key]['getter'](d)
-            else:
-                value = d[config_dict[key].get('key', key)]
-            value = config_dict[key].get('format', str)(value)
-            format.append(value)
-    return '  '.join(format)
+    return '  '.join([str(getter(d)) for key, getter in compile_print_part(config, print_part)])
+
+
+AUDIO_CONFIG = [
+    {'id': {}},
+    {'name': {'getter': lambda d: make_audio_name(d['artist'], d['title'])}},
+    {'url': {}}
+]
+ALBUM_CONFIG = [
+    {'id': {}},
+    {'title': {'format': filter_text}}
+]
+GROUP_CONFIG = [
+    {'id': {}},
+    {'name': {'format': filter_text}}
+]
+FRIEND_CONFIG = [
+    {'id': {}},
+    {'name': {'getter': lambda d: filter_text(d['first_name']+ ' '+d['last_name'])}}
+]
 
 
 def format_audio(audio, print_part=None):
@@ -203,11 +532,7 @@ def format_audio(audio, print_part=None):
     :param dict audio: dict describing one audio.
     :param str print_part: id, name, or url. Which part of audio to print. Default is None (print all).
     """
-    return print_part_format(audio, [
-        {'id': {}},
-        {'name': {'getter': lambda d: make_audio_name(d['artist'], d['title'])}},
-        {'url': {}}
-    ], print_part)
+    return print_part_format(audio, AUDIO_CONFIG, print_part)
 
 
 def print_audio(audio, print_part=None):
@@ -222,10 +547,7 @@ def format_album(album, print_part=None):
     :param dict album: dict describing one album.
     :param str print_part: id, or name. Which part of album to print. Default is None (print all).
     """
-    return print_part_format(album, [
-        {'id': {}},
-        {'title': {'format': filter_text}}
-    ], print_part)
+    return print_part_format(album, ALBUM_CONFIG, print_part)
 
 
 def print_album(album, print_part=None):
@@ -240,10 +562,7 @@ def format_group(group, print_part=None):
     :param dict group: dict describing one group.
     :param print_part:  id or name. Which part of group to print. Default is None (print all).
     """
-    return print_part_format(group, [
-        {'id': {}},
-        {'name': {'format': filter_text}}
-    ])
+    return print_part_format(group, GROUP_CONFIG, print_part)
 
 
 def print_group(group, print_part=None):
@@ -258,10 +577,7 @@ def format_friend(friend, print_part=None):
     :param dict friend: dict describing one friend.
     :param print_part:  id or name. Which part of friend to print. Default is None (print all).
     """
-    return print_part_format(friend, [
-        {'id': {}},
-        {'name': {'getter': lambda d: filter_text(d['first_name']+ ' '+d['last_name'])}}
-    ])
+    return print_part_format(friend, FRIEND_CONFIG, print_part)
 
 
 def print_friend(friend, print_part=None):
@@ -269,6 +585,64 @@ def print_friend(friend, print_part=None):
     print(format_friend(friend, print_part))
 
 
+class RecordWriter(object):
+    """
+    Stream formatted items into one buffer, written out every flush_every items and on close.
+
+    :param list config: print config, e.g. AUDIO_CONFIG.
+    :param str print_part: which parts from config to write.
+    :param str output_format: one of OUTPUT_FORMATS.
+    """
+    def __init__(self, config, print_part=None, output_format='text', stream=None, flush_every=1000):
+        self.config = config
+        self.print_part = print_part
+        self.output_format = output_format
+        self.stream = stream or sys.stdout
+        self.flush_every = flush_every
+        self.buffer = io.StringIO()
+        self.pending = 0
+        self.getters = compile_print_part(config, print_part)
+        self.encode = json.JSONEncoder(ensure_ascii=False).encode
+        if output_format in ('csv', 'tsv'):
+            self.csv = csv.writer(self.buffer, delimiter=',' if output_format == 'csv' else '\t', lineterminator='\n')
+            keys = [list(config_item)[0] for config_item in config]
+            if print_part is not None:
+                keys = [key for key in keys if key in print_part.split('+')]
+            self.csv.writerow(keys)
+
+    def write(self, item):
+        if self.output_format == 'ndjson':
+            self.buffer.write(self.encode(dict([(key, getter(item)) for key, getter in self.getters])))
+            self.buffer.write('\n')
+        elif self.output_format in ('csv', 'tsv'):
+            self.csv.writerow([getter(item) for key, getter in self.getters])
+        else:
+            self.buffer.write('  '.join([str(getter(item)) for key, getter in self.getters]))
+            self.buffer.write('\n')
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        started = time.perf_counter()
+        data = self.buffer.getvalue()
+        self.stream.write(data)
+        self.stream.flush()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        stats.registry.record('output', self.output_format, time.perf_counter() - started, len(data), self.pending)
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def ask(message):
     """Ask user a question"""
     if not message.endswith('?'):
@@ -284,11 +658,116 @@ def ask(message):
             print('Invalid character.')
 
 
+class BoundedExecutor(object):
+    """
+    Thread pool whose submit() blocks while too many tasks are pending,
+    so it can be fed straight from a long generator.
+    """
+    def __init__(self, max_workers, max_pending=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.semaphore = threading.BoundedSemaphore(max_pending or max_workers * 2)
+
+    def submit(self, fn, *args, **kwargs):
+        self.semaphore.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(lambda f: self.semaphore.release())
+        return future
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+def format_size(size):
+    """Human readable size in bytes"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return '{:.1f} {}'.format(size, unit)
+
+
+class DownloadProgress(object):
+    """Thread-safe aggregated progress line for concurrent downloads."""
+    render_interval = 0.2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.rendered = 0
+        self.active = dict()
+        self.done = 0
+        self.bytes = 0
+        self.errors = list()
+
+    def update(self, key, transferred, total_size):
+        """:param str key: audio key, as audios of the same name may download to the same file one after another."""
+        with self.lock:
+            self.active[key] = transferred
+            self.render()
+
+    def finish(self, key, error=None, filename=None):
+        with self.lock:
+            self.bytes += self.active.pop(key, 0)
+            if error is None:
+                self.done += 1
+            else:
+                self.errors.append((filename or key, error))
+            self.render(force=True)
+
+    def transferred(self):
+        return self.bytes + sum(self.active.values())
+
+    def render(self, force=False):
+        now = time.time()
+        if not force and now - self.rendered < self.render_interval:
+            return
+        self.rendered = now
+        transferred = self.transferred()
+        speed = transferred / max(now - self.started, 0.001)
+        print('Downloaded: {}  Active: {}  Failed: {}  {} ({}/s)'.format(
+            self.done, len(self.active), len(self.errors), format_size(transferred), format_size(speed)
+        ).ljust(79), end='\r')
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        print()
+        print('Downloaded {} audios, {} in {:.1f}s, {} failed.'.format(
+            self.done, format_size(self.bytes), elapsed, len(self.errors)))
+        for filename, error in self.errors:
+            print('Failed: {} Error: {}'.format(filename, error))
+
+
 class Downloader:
-    def __init__(self, filename, url, with_reporthook=False):
+    def __init__(self, filename, url, with_reporthook=False, progress=None, session=None, limiter=None, segments=1,
+                 key=None, slots=None):
+        """
+        :param DownloadProgress progress: report to shared progress instead of printing own progress line.
+        :param str key: audio key to report progress with. Default is filename.
+        :param requests.Session session: session to reuse connections from.
+        :param vkontakte.RateLimiter limiter: bandwidth limiter, in bytes.
+        :param int segments: download large files over this many connections.
+        :param HostSlots slots: host connection slots, one of which is held, for extra segments.
+        """
         self.filename = filename
         self.url = url
         self.with_reporthook = with_reporthook
+        self.progress = progress
+        self.session = session
+        self.limiter = limiter
+        self.segments = segments
+        self.key = key or filename
+        self.slots = slots
 
     def format_filename(self):
         if len(self.filename) > 50:
@@ -296,33 +775,417 @@ class Downloader:
         return self.filename
 
     def _reporthook(self, transfered, block_size, total_size):
+        if total_size <= 0:
+            print('Downloading {}: {}'.format(self.format_filename(), format_size(transfered * block_size)), end='\r')
+            return
         p = round(((float(transfered)*float(block_size))/float(total_size)) * 100.0, 1)
         print('Downloading {}: {}%'.format(self.format_filename(), p), end='\r')
 
+    def _progress_reporthook(self, transfered, block_size, total_size):
+        transfered *= block_size
+        if total_size > 0:
+            transfered = min(transfered, total_size)
+        self.progress.update(self.key, transfered, total_size)
+
     def start(self):
-        if self.with_reporthook:
-            urlretrieve(self.url, self.filename, reporthook=self._reporthook)
+        reporthook = None
+        if self.progress is not None:
+            reporthook = self._progress_reporthook
+        elif self.with_reporthook:
+            reporthook = self._reporthook
+        if self.segments > 1:
+            download_segmented(self.url, self.filename, self.segments, reporthook, session=self.session,
+                               limiter=self.limiter, slots=self.slots)
         else:
-            urlretrieve(self.url, self.filename)
-        print()
+            download_raw(self.url, self.filename, reporthook, session=self.session, limiter=self.limiter)
+        if self.progress is None:
+            print()
 
 
-def download_raw(url, filename, reporthook=None, chunk_size=1024,):
-    r = requests.get(url, stream=True)
-    with open(filename, 'wb') as f:
-        for n, chunk in enumerate(r.iter_content(chunk_size=chunk_size)):
-            if chunk:
-                f.write(chunk)
-                f.flush()
+def parse_content_range(value):
+    """
+    :param str value: Content-Range header value like "bytes 100-199/1000".
+    :return int: total size, or None if unknown.
+    """
+    total = value.rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+_buffers = threading.local()
+
+
+def get_buffer(size):
+    """:return memoryview: reusable buffer of this thread."""
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = _buffers.buffer = memoryview(bytearray(size))
+    return buffer
+
+
+def read_chunks(raw, buffer):
+    """Read raw stream into buffer, yielding filled part of it."""
+    while True:
+        n = raw.readinto(buffer)
+        if not n:
+            return
+        yield buffer[:n]
+
+
+def preallocate(f, size):
+    """Reserve size bytes for file."""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    f.truncate(size)
+
+
+def read_progress(part):
+    """
+    :return int: downloaded bytes of part. A preallocated part is longer than that, so its progress
+        file tells how many bytes are in. Without progress file, part size is trusted.
+    """
+    if not os.path.exists(part):
+        return 0
+    size = os.path.getsize(part)
+    try:
+        with open(part + PROGRESS_SUFFIX, 'rb') as f:
+            return min(int(f.read()), size)
+    except FileNotFoundError:
+        return size
+    except ValueError:
+        return 0
+
+
+def save_progress(fd, received):
+    """Overwrite progress file in place, so a killed run never leaves it empty."""
+    os.pwrite(fd, b'%020d' % received, 0)
+
+
+def remove_progress(part):
+    if os.path.exists(part + PROGRESS_SUFFIX):
+        os.remove(part + PROGRESS_SUFFIX)
+
+
+def _download_part(url, part, reporthook, chunk_size, session, report_interval, limiter):
+    """Download url into part file, continuing from its downloaded bytes."""
+    offset = read_progress(part)
+    headers = {'Accept-Encoding': 'identity'}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+    r = session.get(url, stream=True, headers=headers, timeout=vkontakte.session_timeout(session))
+    if r.status_code == 416:
+        r.close()
+        if offset and parse_content_range(r.headers.get('content-range', '')) == offset:
+            # Part was complete, the run was stopped before renaming it
+            os.truncate(part, offset)
             if reporthook:
-                reporthook(n, chunk_size, int(r.headers.get('content-length', 1)))
+                reporthook(offset, 1, offset)
+            return
+        os.remove(part)
+        remove_progress(part)
+        raise IncompleteDownload('Can not resume %s' % part)
+    r.raise_for_status()
+    if r.status_code == 206:
+        total = parse_content_range(r.headers.get('content-range', ''))
+    else:
+        total = int(r.headers['content-length']) if 'content-length' in r.headers else None
+        offset = 0
+    received = offset
+    started = time.perf_counter()
+    reported = saved = 0
+    disk_time = 0.0
+    progress_fd = os.open(part + PROGRESS_SUFFIX, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        with open(part, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            # Progress goes first, so a run killed after preallocation resumes from real progress
+            save_progress(progress_fd, offset)
+            if total:
+                preallocate(f, total)
+            try:
+                if r.headers.get('content-encoding', 'identity') == 'identity':
+                    chunks = read_chunks(r.raw, get_buffer(chunk_size))
+                else:
+                    chunks = r.iter_content(chunk_size=chunk_size)
+                for chunk in chunks:
+                    if limiter is not None:
+                        limiter.acquire(len(chunk))
+                    write_started = time.perf_counter()
+                    f.write(chunk)
+                    disk_time += time.perf_counter() - write_started
+                    received += len(chunk)
+                    if write_started - saved >= PROGRESS_INTERVAL:
+                        saved = write_started
+                        f.flush()
+                        save_progress(progress_fd, received)
+                    if reporthook and write_started - reported >= report_interval:
+                        reported = write_started
+                        reporthook(received, 1, total or -1)
+            finally:
+                if total and received != total:
+                    f.truncate(received)
+                f.flush()
+                save_progress(progress_fd, received)
+        if reporthook:
+            reporthook(received, 1, total or -1)
+    finally:
+        os.close(progress_fd)
+        stats.registry.record('download', urlparse(url).netloc, time.perf_counter() - started, received - offset)
+        stats.registry.record('disk', 'write', disk_time, received - offset)
+    if total is not None and received != total:
+        raise IncompleteDownload('Received {} of {} bytes'.format(received, total))
+
+
+def download_raw(url, filename, reporthook=None, chunk_size=DOWNLOAD_BUFFER_SIZE, session=None, retries=3,
+                 report_interval=0.25, limiter=None):
+    """
+    Download url to filename.
+
+    Data is written to filename + PART_SUFFIX, which is resumed with Range requests after failures and
+    on next runs, checked against Content-Length and renamed to filename when complete.
+    The part is preallocated from Content-Length and filled with readinto through a reusable buffer.
+    Downloaded bytes are saved every PROGRESS_INTERVAL seconds to part + PROGRESS_SUFFIX, so a killed
+    run is resumed from where it stopped, not from the preallocated size.
+
+    :param int chunk_size: read buffer size.
+    :param int retries: how many times to resume after connection errors.
+    :param float report_interval: minimal seconds between reporthook calls.
+    :param vkontakte.RateLimiter limiter: bandwidth limiter, in bytes.
+    """
+    import requests
+    import urllib3
+    part = filename + PART_SUFFIX
+    attempt = 0
+    while True:
+        try:
+            _download_part(url, part, reporthook, chunk_size, session or requests, report_interval, limiter)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                urllib3.exceptions.HTTPError, IncompleteDownload):
+            if attempt >= retries:
+                raise
+            attempt += 1
+        else:
+            break
+    os.replace(part, filename)
+    remove_progress(part)
+
+
+def _write_at(fd, data, position):
+    while data:
+        written = os.pwrite(fd, data, position)
+        data = data[written:]
+        position += written
+
+
+def _download_segment(url, fd, start, end, progress, chunk_size, session, retries, limiter, stop):
+    """Download bytes start to end (inclusive) of url into file descriptor fd at the same offsets."""
+    import requests
+    import urllib3
+    position = start
+    attempt = 0
+    while True:
+        if stop.is_set():
+            raise IncompleteDownload('Stopped at byte %d' % position)
+        offset = position
+        started = time.perf_counter()
+        disk_time = 0.0
+        try:
+            r = session.get(url, stream=True, headers={'Accept-Encoding': 'identity',
+                                                       'Range': 'bytes=%d-%d' % (position, end)},
+                            timeout=vkontakte.session_timeout(session))
+            try:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise RangeIgnored('Server ignored Range of %s' % url)
+                if not r.headers.get('content-range', '').startswith('bytes %d-' % position):
+                    raise IncompleteDownload('Unexpected Content-Range: %s' % r.headers.get('content-range'))
+                for chunk in read_chunks(r.raw, get_buffer(chunk_size)):
+                    if len(chunk) > end + 1 - position:
+                        raise IncompleteDownload('Segment {}-{} got more bytes than asked'.format(start, end))
+                    if stop.is_set():
+                        raise IncompleteDownload('Stopped at byte %d' % position)
+                    if limiter is not None:
+                        limiter.acquire(len(chunk))
+                    write_started = time.perf_counter()
+                    _write_at(fd, chunk, position)
+                    disk_time += time.perf_counter() - write_started
+                    position += len(chunk)
+                    progress(len(chunk))
+            finally:
+                r.close()
+            if position != end + 1:
+                raise IncompleteDownload('Segment {}-{} stopped at byte {}'.format(start, end, position))
+            return
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                urllib3.exceptions.HTTPError, IncompleteDownload):
+            if attempt >= retries or stop.is_set():
+                raise
+            attempt += 1
+        finally:
+            stats.registry.record('download', urlparse(url).netloc, time.perf_counter() - started, position - offset)
+            stats.registry.record('disk', 'write', disk_time, position - offset)
+
+
+def download_segmented(url, filename, segments=4, reporthook=None, chunk_size=DOWNLOAD_BUFFER_SIZE, session=None,
+                       retries=3, report_interval=0.25, limiter=None, min_segment_size=SEGMENT_MIN_SIZE, slots=None):
+    """
+    Download url to filename over up to segments parallel connections.
+
+    Size is told by HEAD request. The file is split into byte ranges of at least min_segment_size, each
+    fetched with its own Range request and written into place in preallocated filename + PART_SUFFIX.
+    Segments are checked against Content-Range and their length, and retried from where they stopped.
+    When all of them are complete, the part is renamed to filename.
+
+    Falls back to download_raw when HEAD request fails, size is unknown, the file is too small to split
+    or the server ignores Range.
+
+    :param HostSlots slots: connection slots of url host, one of which caller holds. Segments beyond
+        the first one are downloaded only over slots that are free once size is known.
+    """
+    import requests
+    session = session or requests
+    total = None
+    if hasattr(os, 'pwrite'):
+        try:
+            r = session.head(url, allow_redirects=True, headers={'Accept-Encoding': 'identity'},
+                             timeout=vkontakte.session_timeout(session))
+            r.raise_for_status()
+        except requests.RequestException:
+            pass  # Some servers do not allow HEAD, size stays unknown
+        else:
+            length = r.headers.get('content-length', '')
+            if r.headers.get('accept-ranges') == 'bytes' and length.isdigit():
+                total = int(length)
+    count = min(segments, total // min_segment_size) if total else 0
+    if count >= 2 and slots is not None:
+        count = 1 + slots.take(count - 1)
+    if count < 2:
+        return download_raw(url, filename, reporthook, chunk_size, session, retries, report_interval, limiter)
+    try:
+        _download_segments(url, filename, total, count, reporthook, chunk_size, session, retries, report_interval,
+                           limiter)
+    finally:
+        if slots is not None:
+            slots.release(count - 1)
+
+
+def _download_segments(url, filename, total, count, reporthook, chunk_size, session, retries, report_interval,
+                       limiter):
+    """Download url of total size into filename over count segments."""
+    from concurrent.futures import ThreadPoolExecutor
+    part = filename + PART_SUFFIX
+    lock = threading.Lock()
+    state = {'received': 0, 'reported': 0}
+    stop = threading.Event()
+
+    def progress(nbytes):
+        if reporthook is None:
+            return
+        with lock:
+            state['received'] += nbytes
+            now = time.perf_counter()
+            if now - state['reported'] >= report_interval:
+                state['reported'] = now
+                reporthook(state['received'], 1, total)
+
+    try:
+        with open(part, 'wb') as f:
+            # Segments are not resumable, a run killed before rename resumes from zero
+            with open(part + PROGRESS_SUFFIX, 'wb') as progress_file:
+                save_progress(progress_file.fileno(), 0)
+            preallocate(f, total)
+            with ThreadPoolExecutor(count) as executor:
+                futures = [executor.submit(_download_segment, url, f.fileno(), total * n // count,
+                                           total * (n + 1) // count - 1, progress, chunk_size, session, retries,
+                                           limiter, stop)
+                           for n in range(count)]
+                try:
+                    for future in futures:
+                        future.result()
+                finally:
+                    stop.set()
+    except RangeIgnored:
+        os.remove(part)
+        remove_progress(part)
+        return download_raw(url, filename, reporthook, chunk_size, session, retries, report_interval, limiter)
+    except:
+        # Do not leave a part with holes for download_raw to resume
+        if os.path.exists(part):
+            os.remove(part)
+        remove_progress(part)
+        raise
+    if reporthook:
+        reporthook(total, 1, total)
+    os.replace(part, filename)
+    remove_progress(part)
+
+
+def file_checksum(filename, algorithm='md5'):
+    """:return str: hex digest of file."""
+    import hashlib
+    digest = hashlib.new(algorithm)
+    with open(filename, 'rb', buffering=0) as f:
+        for chunk in read_chunks(f, get_buffer(DOWNLOAD_BUFFER_SIZE)):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def probe_size(url, session=None):
+    """:return int: size of file at url told by HEAD request, or None if server does not tell it."""
+    import requests
+    started = time.perf_counter()
+    session = session or requests
+    r = session.head(url, allow_redirects=True, headers={'Accept-Encoding': 'identity'},
+                     timeout=vkontakte.session_timeout(session))
+    stats.registry.record('probe', urlparse(url).netloc, time.perf_counter() - started)
+    r.raise_for_status()
+    length = r.headers.get('content-length', '')
+    return int(length) if length.isdigit() else None
+
+
+def probe_sizes(audios, jobs=8, session=None):
+    """
+    Probe sizes of audios with up to jobs concurrent HEAD requests.
+
+    :return: generator of (audio, size, error) tuples in order of audios. Size is None if unknown.
+    """
+    def probe(audio):
+        if not audio.get('url'):
+            return audio, None, 'no url'
+        try:
+            return audio, probe_size(audio['url'], session), None
+        except Exception as e:
+            return audio, None, str(e) or e.__class__.__name__
+
+    in_flight = collections.deque()
+    with BoundedExecutor(jobs) as executor:
+        for audio in audios:
+            in_flight.append(executor.submit(probe, audio))
+            while in_flight and (in_flight[0].done() or len(in_flight) > jobs * 4):
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
 
 
 def from_ids_file(id_file):
+    """Read audio ids, or "<owner_id>_<audio_id>" pairs, one per line."""
     for line in id_file:
         line = line.strip()
         if line:
-            yield int(line)
+            yield line if '_' in line else int(line)
+
+
+def iter_chunks(iterable, size):
+    """Split iterable into lists of size items, the last one may be shorter."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def directory_type(path):
@@ -342,6 +1205,95 @@ def make_full_audio_filename(audio, destination=None):
     return filename
 
 
-def download_audio(audio, destination=None):
+def download_audio(audio, destination=None, progress=None, session=None, limiter=None, segments=1, slots=None):
+    import index
     filename = make_full_audio_filename(audio, destination)
-    Downloader(filename, audio['url'], with_reporthook=True).start()
\ No newline at end of file
+    Downloader(filename, audio['url'], with_reporthook=True, progress=progress, session=session, limiter=limiter,
+               segments=segments, key=index.audio_key(audio), slots=slots).start()
+
+
+def size_type(value):
+    """Parse size like 512K, 2M or 1G into bytes."""
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().rstrip('B')
+    try:
+        if value and value[-1] in multipliers:
+            return int(float(value[:-1]) * multipliers[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a size' % value)
+
+
+DOWNLOAD_ORDERS = ('listing', 'smallest', 'album')
+
+
+class DownloadScheduler(object):
+    """
+    Global bandwidth cap, per host connection limit and ordering policy for downloads.
+
+    :param int max_rate: bytes per second for all downloads together. Default is unlimited.
+    :param int per_host: connections per CDN host. Default is unlimited. A download takes one of them,
+        a segmented one takes more for its other segments if they are free.
+    :param str order: one of DOWNLOAD_ORDERS. listing keeps API order and streams,
+        smallest sorts by size (or duration if size is unknown), album groups audios by album.
+    :param int segments: connections to download one large file over.
+    """
+    def __init__(self, max_rate=None, per_host=None, order='listing', segments=1):
+        self.limiter = vkontakte.RateLimiter(max_rate, max(max_rate, DOWNLOAD_BUFFER_SIZE)) if max_rate else None
+        self.per_host = per_host
+        self.order_policy = order
+        self.segments = segments
+        self.hosts = dict()
+        self.lock = threading.Lock()
+
+    def order(self, audios):
+        if self.order_policy == 'smallest':
+            return sorted(audios, key=lambda audio: audio.get('size') or audio.get('duration') or 0)
+        if self.order_policy == 'album':
+            return sorted(audios, key=lambda audio: audio.get('album_id') or 0)
+        return audios
+
+    def host_slots(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostSlots(self.per_host)
+            return self.hosts[host]
+
+    def download(self, audio, destination=None, progress=None, session=None):
+        if not self.per_host:
+            return download_audio(audio, destination, progress, session, self.limiter, self.segments)
+        slots = self.host_slots(audio['url'])
+        slots.acquire()
+        try:
+            return download_audio(audio, destination, progress, session, self.limiter, self.segments, slots)
+        finally:
+            slots.release()
+
+
+class HostSlots(object):
+    """
+    Connection slots of one host. A download waits for one slot, extra ones are only taken if free,
+    so downloads holding some slots never wait for each other.
+    """
+    def __init__(self, limit):
+        self.free = limit
+        self.condition = threading.Condition()
+
+    def acquire(self, count=1):
+        with self.condition:
+            self.condition.wait_for(lambda: self.free >= count)
+            self.free -= count
+
+    def take(self, count):
+        """:return int: how many of count slots were free and are taken now."""
+        with self.condition:
+            taken = min(count, self.free)
+            self.free -= taken
+            return taken
+
+    def release(self, count=1):
+        with self.condition:
+            self.free += count
+            self.condition.notify_all()
+
@@ -1,8 +1,9 @@
-import requests
-from http import cookiejar as cookielib
-import urllib.request as urllib2
-from urllib.parse import urlparse, urlencode
-from html.parser import HTMLParser
+import json
+import random
+import stats
+import threading
+import time
+from urllib.parse import urlencode
 
 
 class VkontakteError(Exception):
@@ -14,15 +15,135 @@ class VkontakteError(Exception):
         self.request_params = error['request_params']
 
 
+EXECUTE_LIMIT = 25
+# Too many requests per second, internal server error
+RETRY_ERROR_CODES = (6, 10)
+AUTH_ERROR_CODE = 5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Seconds to wait for connection and between bytes of response
+DEFAULT_TIMEOUT = (10, 60)
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all threads using it.
+
+    :param float rate: tokens added per second.
+    :param float burst: bucket capacity. Default is rate.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        """
+        Block until tokens are available and take them.
+
+        :return float: seconds waited.
+        """
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def penalize(self, delay):
+        """Make every waiting thread pause for at least delay seconds."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -delay * self.rate)
+
+
+class TransientError(Exception): pass
+
+
+def make_session(pool_size=10, pool_hosts=32, timeout=DEFAULT_TIMEOUT):
+    """
+    Create keep-alive session with connection pool.
+
+    :param int pool_size: how many connections to keep open per host.
+    :param int pool_hosts: how many per host pools to keep.
+    :param tuple timeout: (connect, read) timeouts in seconds for requests made with session.
+    :return requests.Session: session.
+    """
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.timeout = timeout
+    return session
+
+
+def session_timeout(session):
+    """:return tuple: (connect, read) timeouts to make requests with session, or with requests module."""
+    return getattr(session, 'timeout', DEFAULT_TIMEOUT)
+
+
+def connection_stats(session):
+    """
+    Count connections opened and reused by session pools.
+
+    :param requests.Session session: session made with make_session.
+    :return dict: opened, reused and requests counters.
+    """
+    opened = requests_made = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                requests_made += pool.num_requests
+    return {'opened': opened, 'reused': max(requests_made - opened, 0), 'requests': requests_made}
+
+
 class VkontakteClient:
     api_version = '5.34'
+    api_url = 'https://api.vk.com/method/'
+    backoff_base = 0.5
+    backoff_max = 30.0
 
-    def __init__(self, access_token=None, api_version=None):
+    def __init__(self, access_token=None, api_version=None, session=None, pool_size=10, rate=3, max_retries=5,
+                 user_id=None, reauth=None, timeout=DEFAULT_TIMEOUT):
+        """
+        :param requests.Session session: shared session. Default is a new one from make_session.
+        :param int pool_size: connections per host for new session.
+        :param float rate: API requests per second.
+        :param int max_retries: how many times to retry throttled and failed requests.
+        :param int user_id: id of the token owner, if known.
+        :param reauth: function returning new access token, called once on authorization error.
+        :param tuple timeout: (connect, read) timeouts in seconds. Timed out requests are retried.
+        """
         self.access_token = access_token
+        self.user_id = user_id
+        self.reauth = reauth
+        self.reauth_lock = threading.Lock()
         if api_version is not None:
             self.api_version = api_version
+        self.session = session or make_session(pool_size, timeout=timeout)
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate)
+        self.max_retries = max_retries
 
-    def _compile_params(self, params_dict):
+    def connection_stats(self):
+        return connection_stats(self.session)
+
+    def _api_params(self, params_dict):
         params = list()
         for key in params_dict:
             if params_dict[key]:
@@ -30,6 +151,10 @@ class VkontakteClient:
                     params.append((key, ','.join(map(str, params_dict[key]))))
                 else:
                     params.append((key, str(params_dict[key])))
+        return params
+
+    def _compile_params(self, params_dict):
+        params = self._api_params(params_dict)
         if self.access_token:
             params.append(("access_token", str(self.access_token)))
         params.append(('v', str(self.api_version)))
@@ -40,105 +165,157 @@ class VkontakteClient:
         access_token = auth(email, password, application_id, scope)[0]
         return cls(access_token)
 
+    def backoff(self, attempt):
+        """Exponential backoff delay with jitter."""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _send(self, method, params, post=False):
+        started = time.perf_counter()
+        if post:
+            r = self.session.post(self.api_url + method, data=params, timeout=self.timeout)
+        else:
+            r = self.session.get('{}{}?{}'.format(self.api_url, method, urlencode(params)), timeout=self.timeout)
+        stats.registry.record('api', method, time.perf_counter() - started, len(r.content))
+        if r.status_code in RETRY_STATUS_CODES:
+            raise TransientError('HTTP %s' % r.status_code)
+        return r.json()
+
+    def _request(self, method, params, post=False):
+        """
+        Make paced API request, retrying throttled and transiently failed ones.
+
+        :return dict: whole API response.
+        """
+        import requests
+        attempt = 0
+        reauthorized = False
+        while True:
+            waited = self.rate_limiter.acquire()
+            if waited:
+                stats.registry.record('throttle', 'rate_limiter', waited)
+            try:
+                response = self._send(method, params, post)
+            except (requests.ConnectionError, requests.Timeout, TransientError):
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                if 'error' not in response:
+                    return response
+                if int(response['error']['error_code']) == AUTH_ERROR_CODE and self.reauth and not reauthorized:
+                    params = self._reauthorize(params)
+                    reauthorized = True
+                    continue
+                if int(response['error']['error_code']) not in RETRY_ERROR_CODES or attempt >= self.max_retries:
+                    raise VkontakteError(response['error'])
+                delay = self.backoff(attempt)
+                if int(response['error']['error_code']) == 6:
+                    self.rate_limiter.penalize(delay)
+            stats.registry.record('retry', method, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _reauthorize(self, params):
+        """Get new access token unless another thread already did, and put it into params."""
+        used_token = dict(params).get('access_token')
+        with self.reauth_lock:
+            if self.access_token == used_token:
+                self.access_token = self.reauth()
+        return [(key, self.access_token if key == 'access_token' else value) for key, value in params]
+
     def call(self, method, **params_dict):
         params = self._compile_params(params_dict)
-        url = 'https://api.vk.com/method/{}?{}'.format(method, urlencode(params))
-        response = requests.get(url).json()
-        if 'error' in response:
-            raise VkontakteError(response['error'])
-        return response['response']
-
-
-class _FormParser(HTMLParser):
-    def __init__(self):
-        HTMLParser.__init__(self)
-        self.url = None
-        self.params = {}
-        self.in_form = False
-        self.form_parsed = False
-        self.method = "GET"
-
-    def handle_starttag(self, tag, attrs):
-        tag = tag.lower()
-        if tag == "form":
-            if self.form_parsed:
-                raise ValueError("Second form on page")
-            if self.in_form:
-                raise ValueError("Already in form")
-            self.in_form = True
-        if not self.in_form:
-            return
-        attrs = dict((name.lower(), value) for name, value in attrs)
-        if tag == "form":
-            self.url = attrs["action"]
-            if "method" in attrs:
-                self.method = attrs["method"].upper()
-        elif tag == "input" and "type" in attrs and "name" in attrs:
-            if attrs["type"] in ["hidden", "text", "password"]:
-                self.params[attrs["name"]] = attrs["value"] if "value" in attrs else ""
-
-    def handle_endtag(self, tag):
-        tag = tag.lower()
-        if tag == "form":
-            if not self.in_form:
-                raise RuntimeError("Unexpected end of <form>")
-            self.in_form = False
-            self.form_parsed = True
+        return self._request(method, params)['response']
+
+    def batch(self):
+        """
+        Make a batch of calls sent with execute method.
+
+        :return Batch: batch bound to this client.
+        """
+        return Batch(self)
+
+    def execute(self, calls):
+        """
+        Send up to EXECUTE_LIMIT calls in one execute request and set their results.
+
+        :param list calls: list of BatchCall.
+        """
+        if len(calls) > EXECUTE_LIMIT:
+            raise ValueError('Execute accepts only %s calls' % EXECUTE_LIMIT)
+        code = 'return [{}];'.format(','.join(
+            'API.{}({})'.format(call.method, json.dumps(dict(self._api_params(call.params)), ensure_ascii=False))
+            for call in calls
+        ))
+        params = self._compile_params({'code': code})
+        response = self._request('execute', params, post=True)
+        errors = iter(response.get('execute_errors', list()))
+        for call, result in zip(calls, response['response']):
+            if result is False:
+                error = next(errors, {'error_code': 0, 'error_msg': 'Unknown execute error'})
+                error.setdefault('request_params', self._api_params(call.params))
+                call.error = error
+            else:
+                call.response = result
+            call.done = True
+
+
+class BatchCall(object):
+    """Result of the call queued in Batch."""
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.response = None
+        self.error = None
+        self.done = False
+
+    def result(self):
+        """
+        :return: call response.
+        :raises VkontakteError: if this call failed.
+        """
+        if not self.done:
+            raise RuntimeError('Batch was not sent yet')
+        if self.error is not None:
+            raise VkontakteError(self.error)
+        return self.response
+
+
+class Batch(object):
+    """
+    Queue of calls merged into execute requests.
+
+    Calls are sent when EXECUTE_LIMIT calls are queued and when leaving the with block.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.queue = list()
+
+    def call(self, method, **params_dict):
+        call = BatchCall(method, params_dict)
+        self.queue.append(call)
+        if len(self.queue) >= EXECUTE_LIMIT:
+            self.flush()
+        return call
+
+    def flush(self):
+        while self.queue:
+            calls, self.queue = self.queue[:EXECUTE_LIMIT], self.queue[EXECUTE_LIMIT:]
+            self.client.execute(calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
 
 
 def auth(email, password, client_id, scope):
-    def split_key_value(kv_pair):
-        kv = kv_pair.split("=")
-        return kv[0], kv[1]
-
-    # Authorization form
-    def auth_user(email, password, client_id, scope, opener):
-        response = opener.open(
-            "http://oauth.vk.com/oauth/authorize?" + \
-            "redirect_uri=http://oauth.vk.com/blank.html&response_type=token&" + \
-            "client_id=%s&scope=%s&display=wap" % (client_id, ",".join(scope))
-        )
-        doc = response.read().decode()
-        parser = _FormParser()
-        parser.feed(doc)
-        parser.close()
-        if not parser.form_parsed or parser.url is None or "pass" not in parser.params or \
-                        "email" not in parser.params:
-            raise ValueError("Something wrong")
-        parser.params["email"] = email
-        parser.params["pass"] = password
-        if parser.method == "POST":
-            response = opener.open(parser.url, urlencode(parser.params).encode())
-        else:
-            raise NotImplementedError("Method '%s'" % parser.method)
-        r = response.read()
-        return r.decode('windows-1251'), response.geturl()
-
-    # Permission request form
-    def give_access(doc, opener):
-        parser = _FormParser()
-        parser.feed(doc)
-        parser.close()
-        if not parser.form_parsed or parser.url is None:
-            raise ValueError("Something wrong")
-        if parser.method == "POST":
-            response = opener.open(parser.url, urlencode(parser.params).encode())
-        else:
-            raise NotImplementedError("Method '%s'" % parser.method)
-        return response.geturl()
-
-    if not isinstance(scope, list):
-        scope = [scope]
-    opener = urllib2.build_opener(
-        urllib2.HTTPCookieProcessor(cookielib.CookieJar()),
-        urllib2.HTTPRedirectHandler())
-    doc, url = auth_user(email, password, client_id, scope, opener)
-    if urlparse(url).path != "/blank.html":
-        # Need to give access to requested scope
-        url = give_access(doc, opener)
-    if urlparse(url).path != "/blank.html":
-        raise ValueError("Expected success here")
-    answer = dict(split_key_value(kv_pair) for kv_pair in urlparse(url).fragment.split("&"))
-    if "access_token" not in answer or "user_id" not in answer:
-        raise ValueError("Missing some values in answer")
-    return answer["access_token"], answer["user_id"], answer["expires_in"]
+    """
+    Authorize through OAuth form and return access_token, user_id and expires_in.
+    The form parsing code is imported only when authorization is needed.
+    """
+    import oauth
+    return oauth.auth(email, password, client_id, scope)